@@ -0,0 +1,57 @@
+import argparse, os, statistics, time
+from concurrent.futures import ThreadPoolExecutor
+from source import artifacts, downloads
+from source.sigstore import sigstore_shim
+
+# Runs the bridge's verification pipeline against a running stand-in (see
+# loadtest/standin.py) many times concurrently, then reports throughput and
+# latency percentiles. Run from the repository root:
+#
+#   python -m loadtest.bench http://127.0.0.1:8080 --runs 50 --concurrency 10
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def run_once(owner, repository, intoto, sigstore_verify, workers):
+    start = time.monotonic()
+    with downloads.Downloader(workers) as downloader:
+        artifacts.fetch_verified_hashes(owner, repository, "standin-token", None, sigstore_verify, dict(intoto) if intoto else None, downloader)
+    return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure bridge throughput and tail latency against the local stand-in")
+    parser.add_argument("url", help="base URL of the stand-in, e.g. http://127.0.0.1:8080")
+    parser.add_argument("-o", "--owner", default="example", action="store")
+    parser.add_argument("-r", "--repository", default="app", action="store")
+    parser.add_argument("-n", "--runs", help="total number of verification runs", type=int, default=20, action="store")
+    parser.add_argument("-c", "--concurrency", help="number of verification runs in flight at once", type=int, default=4, action="store")
+    parser.add_argument("-w", "--workers", help="concurrent downloads per run", type=int, default=downloads.DEFAULT_WORKERS, action="store")
+    parser.add_argument("-i", "--intoto", help="in-toto verification type, e.g. 'simple'", action="store")
+    parser.add_argument("-s", "--sigstore", help="also run the Sigstore checks (sigstore-python needs real Fulcio certificates)", action="store_true")
+    args = parser.parse_args()
+
+    os.environ["GITHUB_GRAPHQL_URL"] = f"{args.url}/graphql"
+    sigstore_shim.REKOR_URL = args.url
+    intoto = {"layout_path": args.intoto, "layout_key": None, "layout_key_password": None} if args.intoto else None
+
+    latencies = []
+    failures = 0
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_once, args.owner, args.repository, intoto, args.sigstore, args.workers) for _ in range(args.runs)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception as e:
+                failures += 1
+                print(f"Run failed: {e}")
+    elapsed = time.monotonic() - start
+
+    print(f"{args.runs} runs ({failures} failed) at concurrency {args.concurrency} in {elapsed:.2f}s: {len(latencies) / elapsed:.2f} runs/s")
+    if latencies:
+        print(f"latency mean {statistics.mean(latencies):.3f}s  p50 {percentile(latencies, 0.5):.3f}s  "
+              f"p90 {percentile(latencies, 0.9):.3f}s  p99 {percentile(latencies, 0.99):.3f}s  max {max(latencies):.3f}s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import argparse, base64, hashlib, json, os, random, re, socket, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the services the bridge talks to, for load testing without
+# reaching github.com or rekor.sigstore.dev:
+#
+# - POST /graphql                        Github GraphQL (latestRelease, release(tagName)
+#                                        and the aliased multi-repository queries)
+# - GET  /download/<owner>/<repo>/<tag>/<asset>
+#                                        release asset downloadUrls, with ETag and Range support
+# - POST /api/v1/index/retrieve          Rekor search by hash
+# - GET  /api/v1/log/entries/<uuid>      Rekor entry by UUID
+# - POST /api/v1/log/entries/retrieve    Rekor bulk retrieve
+# - GET  /_stats                         request and byte counters of the stand-in
+#
+# Fixtures live in a directory laid out as:
+#
+#   <fixtures>/releases/<owner>/<repo>/<tag>/<asset files>
+#   <fixtures>/rekor/entries.json        {uuid: Rekor log entry}
+#
+# The latest release of a repository is the tag listed in
+# <fixtures>/releases/<owner>/<repo>/latest, or the last tag in sorted order.
+# Use --generate to create a signed sample release and matching Rekor entries.
+
+# Tree ID prepended to entry UUIDs in search results, like the public Rekor instance does.
+REKOR_TREE_ID = "24296fb24b8ad77a"
+
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, bandwidth=0, error_rate=0.0, reset_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "bytes_sent": 0, "errors_injected": 0, "resets_injected": 0}
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+class Fixtures:
+    def __init__(self, directory, base_url):
+        self.releases_dir = os.path.join(directory, "releases")
+        self.base_url = base_url
+        self.rekor_entries = {}
+        rekor_path = os.path.join(directory, "rekor", "entries.json")
+        if os.path.exists(rekor_path):
+            with open(rekor_path, "r") as f:
+                self.rekor_entries = json.load(f)
+
+        # Index Rekor entries by the artifact hash recorded in their body.
+        self.rekor_by_hash = {}
+        for uuid, entry in self.rekor_entries.items():
+            body = json.loads(base64.b64decode(entry["body"]))
+            artifact_hash = body["spec"]["data"]["hash"]["value"]
+            self.rekor_by_hash.setdefault(artifact_hash, []).append(uuid)
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def asset_path(self, owner, repo, tag, name):
+        path = os.path.realpath(os.path.join(self.releases_dir, owner, repo, tag, name))
+        if not path.startswith(os.path.realpath(self.releases_dir) + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def digest(self, path):
+        with self._lock:
+            if path not in self._digests:
+                digest = hashlib.sha256()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        digest.update(chunk)
+                self._digests[path] = digest.hexdigest()
+            return self._digests[path]
+
+    def release(self, owner, repo, tag=None):
+        repo_dir = os.path.join(self.releases_dir, owner, repo)
+        if not os.path.isdir(repo_dir):
+            return None
+        if tag is None:
+            latest_path = os.path.join(repo_dir, "latest")
+            if os.path.exists(latest_path):
+                with open(latest_path, "r") as f:
+                    tag = f.read().strip()
+            else:
+                tags = sorted(t for t in os.listdir(repo_dir) if os.path.isdir(os.path.join(repo_dir, t)))
+                if not tags:
+                    return None
+                tag = tags[-1]
+        tag_dir = os.path.join(repo_dir, tag)
+        if not os.path.isdir(tag_dir):
+            return None
+
+        nodes = []
+        for name in sorted(os.listdir(tag_dir)):
+            path = os.path.join(tag_dir, name)
+            nodes.append({
+                "name": name,
+                "downloadUrl": f"{self.base_url}/download/{owner}/{repo}/{tag}/{name}",
+                "size": os.path.getsize(path),
+                "digest": f"sha256:{self.digest(path)}",
+            })
+        return {
+            "tagName": tag,
+            "releaseAssets": {"pageInfo": {"endCursor": None, "hasNextPage": False}, "nodes": nodes},
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if not self._inject_faults():
+            return
+        if self.path == "/_stats":
+            with self.server.stats.lock:
+                counters = dict(self.server.stats.counters)
+            return self._send_json(counters)
+        match = re.fullmatch(r"/download/([^/]+)/([^/]+)/([^/]+)/([^/]+)", self.path)
+        if match:
+            return self._send_asset(*match.groups())
+        match = re.fullmatch(r"/api/v1/log/entries/([0-9a-f]+)", self.path)
+        if match:
+            entry = self._rekor_entry(match.group(1))
+            if entry is None:
+                return self._send_json({"code": 404, "message": "entry not found"}, 404)
+            return self._send_json({match.group(1): entry})
+        self._send_json({"message": "not found"}, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self._inject_faults():
+            return
+        payload = json.loads(body or b"{}")
+        if self.path == "/graphql":
+            return self._send_json(self._graphql(payload))
+        if self.path == "/api/v1/index/retrieve":
+            artifact_hash = (payload.get("hash") or "").split(":")[-1]
+            uuids = self.server.fixtures.rekor_by_hash.get(artifact_hash, [])
+            return self._send_json([REKOR_TREE_ID + uuid for uuid in uuids])
+        if self.path == "/api/v1/log/entries/retrieve":
+            entries = []
+            for uuid in payload.get("entryUUIDs", []):
+                entry = self._rekor_entry(uuid)
+                if entry is not None:
+                    entries.append({REKOR_TREE_ID + uuid[-64:]: entry})
+            return self._send_json(entries)
+        self._send_json({"message": "not found"}, 404)
+
+    # Applies latency and error injection. Returns False if the request was answered with an error.
+    def _inject_faults(self):
+        faults = self.server.faults
+        self.server.stats.add("requests")
+        delay = faults.latency + random.uniform(0, faults.jitter)
+        if delay:
+            time.sleep(delay)
+        if random.random() < faults.error_rate:
+            self.server.stats.add("errors_injected")
+            self._send_json({"message": "injected error"}, 503)
+            return False
+        return True
+
+    def _graphql(self, payload):
+        query = payload["query"]
+        variables = payload.get("variables") or {}
+        if isinstance(variables, str):
+            variables = json.loads(variables)
+        fixtures = self.server.fixtures
+
+        aliases = re.findall(r"(r(\d+)): repository\(owner: \$owner\d+, name: \$repo\d+\) \{ (latestRelease|release\(tagName: \$tag\d+\))", query)
+        if aliases:
+            # Like Github, a missing repository only nulls its own alias.
+            data, errors = {}, []
+            for alias, i, field in aliases:
+                tag = variables.get(f"tag{i}") if field.startswith("release(") else None
+                release = fixtures.release(variables[f"owner{i}"], variables[f"repo{i}"], tag)
+                if release is None and not os.path.isdir(os.path.join(fixtures.releases_dir, variables[f"owner{i}"], variables[f"repo{i}"])):
+                    data[alias] = None
+                    errors.append({"type": "NOT_FOUND", "path": [alias], "message": f"Could not resolve to a Repository with the name '{variables[f'owner{i}']}/{variables[f'repo{i}']}'."})
+                    continue
+                data[alias] = {"latestRelease" if field == "latestRelease" else "release": release}
+            return {"data": data, "errors": errors} if errors else {"data": data}
+
+        field = "release" if "release(tagName" in query else "latestRelease"
+        if not os.path.isdir(os.path.join(fixtures.releases_dir, variables["owner"], variables["repo"])):
+            return {"data": {"repository": None}, "errors": [{"type": "NOT_FOUND", "path": ["repository"], "message": f"Could not resolve to a Repository with the name '{variables['owner']}/{variables['repo']}'."}]}
+        release = fixtures.release(variables["owner"], variables["repo"], variables.get("tagName"))
+        return {"data": {"repository": {field: release}}}
+
+    def _rekor_entry(self, uuid):
+        return self.server.fixtures.rekor_entries.get(uuid[-64:])
+
+    def _send_json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self._write(body)
+
+    def _send_asset(self, owner, repo, tag, name):
+        path = self.server.fixtures.asset_path(owner, repo, tag, name)
+        if path is None:
+            return self._send_json({"message": "not found"}, 404)
+        etag = f'"{self.server.fixtures.digest(path)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        range_match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        # A Range guarded by an outdated If-Range validator gets the whole asset.
+        if self.headers.get("If-Range") not in (None, etag):
+            range_match = None
+        if range_match and int(range_match.group(1)) < size:
+            start = int(range_match.group(1))
+            end = min(int(range_match.group(2)), size - 1) if range_match.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        # Connection resets are injected halfway through the body.
+        reset_at = None
+        if random.random() < self.server.faults.reset_rate:
+            reset_at = start + (end - start + 1) // 2
+        with open(path, "rb") as f:
+            f.seek(start)
+            position = start
+            while position <= end:
+                chunk = f.read(min(64 * 1024, end - position + 1))
+                if reset_at is not None and position + len(chunk) > reset_at:
+                    self._write(chunk[:reset_at - position])
+                    self.server.stats.add("resets_injected")
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                self._write(chunk)
+                position += len(chunk)
+
+    # Writes data to the client, throttled to the configured bandwidth.
+    def _write(self, data):
+        bandwidth = self.server.faults.bandwidth
+        self.wfile.write(data)
+        self.server.stats.add("bytes_sent", len(data))
+        if bandwidth:
+            time.sleep(len(data) / bandwidth)
+
+def make_server(fixtures_dir, host="127.0.0.1", port=8080, faults=None, verbose=False):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.fixtures = Fixtures(fixtures_dir, f"http://{host}:{server.server_address[1]}")
+    server.faults = faults or Faults()
+    server.stats = Stats()
+    server.verbose = verbose
+    return server
+
+# Generates a sample release for owner/repo at tag: count signed binaries of
+# size bytes each with .sig/.crt files, a compile link listing them as products,
+# and one single-leaf Rekor entry per binary with a valid inclusion proof.
+def generate_fixtures(fixtures_dir, owner="example", repo="app", tag="v1.0.0", count=3, size=1024 * 1024):
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    import datetime
+
+    release_dir = os.path.join(fixtures_dir, "releases", owner, repo, tag)
+    rekor_dir = os.path.join(fixtures_dir, "rekor")
+    os.makedirs(release_dir, exist_ok=True)
+    os.makedirs(rekor_dir, exist_ok=True)
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "supply-chain-bridge standin")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    crt = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+        .serial_number(x509.random_serial_number()).not_valid_before(now)
+        .not_valid_after(now + datetime.timedelta(days=365)).sign(key, hashes.SHA256()))
+    crt_pem = crt.public_bytes(serialization.Encoding.PEM)
+    pub_pem = key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    rekor_entries = {}
+    products = {}
+    for i in range(count):
+        artifact_name = f"app-{i}"
+        artifact = os.urandom(size)
+        artifact_hash = hashlib.sha256(artifact).hexdigest()
+        signature = key.sign(artifact, ec.ECDSA(hashes.SHA256()))
+        with open(os.path.join(release_dir, artifact_name), "wb") as f:
+            f.write(artifact)
+        with open(os.path.join(release_dir, f"{artifact_name}.sig"), "wb") as f:
+            f.write(base64.b64encode(signature))
+        with open(os.path.join(release_dir, f"{artifact_name}.crt"), "wb") as f:
+            f.write(crt_pem)
+        products[artifact_name] = {"sha256": artifact_hash}
+
+        body = base64.b64encode(json.dumps({
+            "apiVersion": "0.0.1",
+            "kind": "hashedrekord",
+            "spec": {
+                "signature": {"content": base64.b64encode(signature).decode(), "publicKey": {"content": base64.b64encode(pub_pem).decode()}},
+                "data": {"hash": {"algorithm": "sha256", "value": artifact_hash}},
+            },
+        }).encode()).decode()
+        leaf_hash = hashlib.sha256(b"\x00" + base64.b64decode(body)).hexdigest()
+        rekor_entries[leaf_hash] = {
+            "body": body,
+            "integratedTime": int(time.time()),
+            "logIndex": i,
+            "verification": {"inclusionProof": {"logIndex": 0, "treeSize": 1, "hashes": [], "rootHash": leaf_hash}},
+        }
+
+    with open(os.path.join(release_dir, "compile.standin.link"), "w") as f:
+        json.dump({"signatures": [], "signed": {"_type": "link", "name": "compile", "materials": {}, "products": products}}, f)
+
+    rekor_path = os.path.join(rekor_dir, "entries.json")
+    if os.path.exists(rekor_path):
+        with open(rekor_path, "r") as f:
+            rekor_entries = {**json.load(f), **rekor_entries}
+    with open(rekor_path, "w") as f:
+        json.dump(rekor_entries, f)
+    print(f"Generated {count} signed artifacts of {size} bytes for {owner}/{repo}@{tag} in {fixtures_dir}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for Github GraphQL, release downloads and Rekor")
+    parser.add_argument("fixtures", help="fixtures directory")
+    parser.add_argument("--host", default="127.0.0.1", action="store")
+    parser.add_argument("--port", type=int, default=8080, action="store")
+    parser.add_argument("--latency", help="added latency per request in milliseconds", type=float, default=0, action="store")
+    parser.add_argument("--jitter", help="additional random latency per request of up to this many milliseconds", type=float, default=0, action="store")
+    parser.add_argument("--bandwidth", help="per-connection bandwidth cap in KiB/s (0 for unlimited)", type=int, default=0, action="store")
+    parser.add_argument("--error_rate", help="fraction of requests answered with 503", type=float, default=0, action="store")
+    parser.add_argument("--reset_rate", help="fraction of asset downloads cut off halfway through", type=float, default=0, action="store")
+    parser.add_argument("--generate", help="generate a sample release before serving", action="store_true")
+    parser.add_argument("--owner", default="example", action="store")
+    parser.add_argument("--repository", default="app", action="store")
+    parser.add_argument("--tag", default="v1.0.0", action="store")
+    parser.add_argument("--count", help="number of binaries generated with --generate", type=int, default=3, action="store")
+    parser.add_argument("--size", help="size in KiB of binaries generated with --generate", type=int, default=1024, action="store")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_fixtures(args.fixtures, args.owner, args.repository, args.tag, args.count, args.size * 1024)
+
+    faults = Faults(args.latency / 1000, args.jitter / 1000, args.bandwidth * 1024, args.error_rate, args.reset_rate)
+    server = make_server(args.fixtures, args.host, args.port, faults, args.verbose)
+    base_url = f"http://{args.host}:{server.server_address[1]}"
+    print(f"Serving stand-ins on {base_url}")
+    print(f"  --github_graphql_url {base_url}/graphql --rekor_url {base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
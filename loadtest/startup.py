@@ -0,0 +1,96 @@
+import argparse, json, os, statistics, subprocess, sys, tempfile, time
+
+# Measures the startup cost of the bridge's CLI in each of its modes: the wall
+# time of a whole run and the time spent importing modules (from Python's
+# -X importtime), along with the heaviest imports. Verification modes run
+# against a running stand-in (see loadtest/standin.py). Run from the repository
+# root:
+#
+#   python -m loadtest.startup http://127.0.0.1:8080 --runs 5 --output startup.json
+#
+# With --baseline, import times are compared against an earlier --output, and
+# the script exits non-zero if any mode regressed by more than --threshold percent.
+
+MODES = ("help", "amend", "simple", "sigstore", "default-layout")
+
+# Returns the command line arguments of each mode.
+def mode_args(url, owner, repository, workdir):
+    output = os.path.join(workdir, "policy.json")
+    verify = ["-o", owner, "-r", repository, "-t", "standin-token", "--github_graphql_url", f"{url}/graphql", "--rekor_url", url, "--no_cache", "-O", output]
+    return {
+        "help": ["--help"],
+        "amend": ["-a", output, "-d", "/usr/bin/app", "-O", output],
+        "simple": verify + ["-i", "simple"],
+        "sigstore": verify + ["-i", "simple", "--sigstore"],
+        "default-layout": verify + ["-i", "default-layout"],
+    }
+
+# Returns the total import time in seconds and the slowest top-level imports
+# ([module, seconds]) from the -X importtime output in stderr.
+def parse_importtime(stderr, top=5):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Only imports at the outermost level, so nested ones are not counted twice.
+        if not name[1:].startswith(" "):
+            imports.append((name.strip(), int(cumulative) / 1e6))
+    slowest = sorted(imports, key=lambda i: i[1], reverse=True)[:top]
+    return sum(seconds for _, seconds in imports), [[name, seconds] for name, seconds in slowest]
+
+def run_once(main_path, args):
+    start = time.monotonic()
+    process = subprocess.run([sys.executable, "-X", "importtime", main_path] + args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.monotonic() - start
+    imports, slowest = parse_importtime(process.stderr)
+    return wall, imports, slowest, process.returncode
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure CLI startup and import time per mode against the local stand-in")
+    parser.add_argument("url", help="base URL of the stand-in, e.g. http://127.0.0.1:8080")
+    parser.add_argument("-o", "--owner", default="example", action="store")
+    parser.add_argument("-r", "--repository", default="app", action="store")
+    parser.add_argument("-n", "--runs", help="runs per mode; medians are reported", type=int, default=5, action="store")
+    parser.add_argument("-m", "--modes", help=f"comma-separated modes to measure (default: {','.join(MODES)})", default=",".join(MODES), action="store")
+    parser.add_argument("--main", help="path of the CLI entry point (default: main.py)", default="main.py", action="store")
+    parser.add_argument("--output", help="filepath to write the measurements to as JSON", action="store")
+    parser.add_argument("--baseline", help="filepath of earlier --output measurements to check for regressions", action="store")
+    parser.add_argument("--threshold", help="percentage an import time may grow over the baseline before it counts as a regression (default: 20)", type=float, default=20, action="store")
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        all_args = mode_args(args.url, args.owner, args.repository, workdir)
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            if mode not in all_args:
+                parser.error(f"unknown mode {mode} (valid: {', '.join(MODES)})")
+            runs = [run_once(args.main, all_args[mode]) for _ in range(args.runs)]
+            results[mode] = {
+                "wall": statistics.median(run[0] for run in runs),
+                "imports": statistics.median(run[1] for run in runs),
+                "slowest_imports": runs[-1][2],
+                "exit_code": runs[-1][3],
+            }
+
+    for mode, result in results.items():
+        failed = "" if result["exit_code"] == 0 else f"  (exited with {result['exit_code']})"
+        slowest = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in result["slowest_imports"])
+        print(f"{mode:<15} wall {result['wall']:.3f}s  imports {result['imports']:.3f}s  slowest: {slowest}{failed}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Measurements written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        regressed = [mode for mode in results if mode in baseline and results[mode]["imports"] > baseline[mode]["imports"] * (1 + args.threshold / 100)]
+        for mode in regressed:
+            print(f"REGRESSION {mode}: imports {baseline[mode]['imports']:.3f}s -> {results[mode]['imports']:.3f}s")
+        if regressed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,17 @@
-import argparse, json, os
-from source import artifacts, allowlists
+import argparse, atexit, datetime, json, os, sys
+from source import artifacts, allowlists, batch, cache, downloads, github, intoto_tools, policy_store, results, server, trace, tree, watch
+from source.sigstore import sigstore_shim
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-o", "--owner", help="Github repository owner", action="store")
     parser.add_argument("-r", "--repository", help="Github repository name", action="store")
     parser.add_argument("-t", "--token", help="Github access token", action="store")
+    parser.add_argument("--tag", help="tag of the Github release to verify (default: the latest release)", action="store")
     parser.add_argument("-l", "--local_app_path", help="local app path", action="store")
     parser.add_argument("-d", "--destination_app_path", help="destination app path on Keylime target", action="store")
     parser.add_argument("-a", "--allowlist", help="local path of Keylime allowlist", action="store")
+    parser.add_argument("-e", "--excludelist", help="local path of a Keylime excludelist (one regular expression per line); matching paths are left out of the policy and the patterns written to its excludes", action="store")
     parser.add_argument(
         "-i", "--intoto",
         help="""
@@ -21,25 +24,201 @@ def main():
     )
     parser.add_argument("-k", "--intoto_key", help="filepath of in-toto layout key, used alongside an in-toto layout path provided to -i or --intoto", action="store")
     parser.add_argument("-p", "--intoto_key_password", help="password used with --intoto_key", action="store")
+    parser.add_argument("--layout_key_type", help="key type of the throwaway key signing the default in-toto layout: 'rsa' (default) or 'ed25519'", choices=["rsa", "ed25519"], default="rsa", action="store")
+    parser.add_argument("--layout_cache_dir", help=f"directory caching the default in-toto layout and its key (default: {intoto_tools.DEFAULT_LAYOUT_CACHE_DIR})", default=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR, action="store")
     parser.add_argument("-s", "--sigstore", help="whether to verify inclusion proofs against Sigstore", action="store_true")
+    parser.add_argument("-w", "--workers", help=f"number of concurrent release asset downloads (default: {downloads.DEFAULT_WORKERS})", type=int, default=downloads.DEFAULT_WORKERS, action="store")
+    parser.add_argument("--ima_hash_algs", help=f"comma-separated digest algorithms of each verified binary written to the policy, matching the file hash algorithm of the targets' IMA logs (any of {', '.join(downloads.SUPPORTED_ALGORITHMS)}; default: sha256). All are computed in one read of each binary", default="sha256", action="store")
+    parser.add_argument("--download_retries", help=f"number of times an interrupted download is resumed before giving up (default: {downloads.DEFAULT_RETRIES})", type=int, default=downloads.DEFAULT_RETRIES, action="store")
+    parser.add_argument("--download_segments", help=f"number of parallel ranged requests assets of at least {downloads.SEGMENT_MIN_SIZE // 2**20} MiB are split into (default: 1)", type=int, default=1, action="store")
+    parser.add_argument("-c", "--cache_dir", help=f"directory of the persistent release asset cache (default: {cache.DEFAULT_CACHE_DIR})", default=cache.DEFAULT_CACHE_DIR, action="store")
+    parser.add_argument("--cache_max_size", help=f"size cap of the release asset cache in MiB (default: {cache.DEFAULT_MAX_BYTES // 2**20})", type=int, default=cache.DEFAULT_MAX_BYTES // 2**20, action="store")
+    parser.add_argument("--results_db", help=f"filepath of the store of verification results, whose passing steps are not run again on unchanged inputs (default: {results.DEFAULT_RESULTS_PATH})", default=results.DEFAULT_RESULTS_PATH, action="store")
+    parser.add_argument("--results_ttl", help=f"hours a stored verification result is trusted before it is evicted and its step run again (default: {results.DEFAULT_TTL})", type=int, default=results.DEFAULT_TTL, action="store")
+    parser.add_argument("--reverify", help="run every verification step again, ignoring stored results (fresh results are still stored)", action="store_true")
+    parser.add_argument("--list_verified", help="list stored verification results, newest first, optionally only those of an artifact SHA-256 digest (or prefix), --owner/--repository and --tag, then exit", nargs="?", const="", metavar="SHA256", action="store")
+    parser.add_argument("--no_cache", help="download every release asset instead of using the persistent cache", action="store_true")
+    parser.add_argument("-b", "--batch", help="filepath of a JSON manifest listing repositories to verify and merge into one policy", action="store")
+    parser.add_argument("-j", "--jobs", help=f"number of repositories verified concurrently in batch mode (default: {batch.DEFAULT_JOBS})", type=int, default=batch.DEFAULT_JOBS, action="store")
+    parser.add_argument("--batch_report", help="filepath to write the per-repository batch report to as JSON", action="store")
+    parser.add_argument("--graphql_batch_size", help=f"number of repositories resolved per Github GraphQL request in batch mode (default: {github.DEFAULT_BATCH_SIZE}, max: {github.MAX_BATCH_SIZE})", type=int, default=github.DEFAULT_BATCH_SIZE, action="store")
+    parser.add_argument("--github_graphql_url", help="URL of the Github GraphQL API (default: $GITHUB_GRAPHQL_URL or https://api.github.com/graphql)", action="store")
+    parser.add_argument("--rekor_url", help=f"base URL of the Rekor transparency log (default: {sigstore_shim.REKOR_URL})", action="store")
+    parser.add_argument("-O", "--output", help="filepath the Keylime policy is written to, or '-' for standard output (default: keylime-policy.json)", default="keylime-policy.json", action="store")
+    parser.add_argument("-z", "--gzip", help="gzip-compress the written Keylime policy (implied by an --output ending in .gz)", action="store_true")
+    parser.add_argument("--policy_store", help="directory keeping every generated policy by release; its newest policy is amended when no --allowlist is given", action="store")
+    parser.add_argument("--retire_after", help=f"number of releases a hash superseded by a newer one for the same path stays allowed in --policy_store policies, 0 to keep it forever (default: {policy_store.DEFAULT_RETIRE_AFTER})", type=int, default=policy_store.DEFAULT_RETIRE_AFTER, action="store")
+    parser.add_argument("--delta_output", help="filepath to write the delta between the previous and the new --policy_store policy to", action="store")
+    parser.add_argument("--apply_delta", help="filepath of a policy delta to apply to --allowlist (or the newest --policy_store policy), writing the result to --output", action="store")
+    parser.add_argument("--tree", help="directory of an unpacked release tree or image rootfs: hash all its files and write them to the policy, or diff them against --tree_link", action="store")
+    parser.add_argument("--tree_link", help="filepath of an in-toto link whose products --tree is checked against instead of writing a policy", action="store")
+    parser.add_argument("--tree_report", help="filepath to write the --tree_link comparison to as JSON", action="store")
+    parser.add_argument("--tree_prefix", help="path --tree is mounted at on the Keylime target (default: /)", default="/", action="store")
+    parser.add_argument("--tree_index", help="filepath of the index of already-hashed --tree files, whose unchanged files are not hashed again (default: one per tree in the cache directory)", action="store")
+    parser.add_argument("--tree_workers", help=f"number of processes hashing --tree files (default: {os.cpu_count()})", type=int, default=os.cpu_count(), action="store")
+    parser.add_argument("--trace", help="filepath to write timing spans of every stage and artifact to (wall time, bytes, HTTP requests, cache hits and misses, peak RSS)", action="store")
+    parser.add_argument("--trace_format", help="format of --trace: 'jsonl' (one span per line, default) or 'chrome' (Chrome trace, viewable in chrome://tracing or Perfetto)", choices=trace.FORMATS, default="jsonl", action="store")
+    parser.add_argument("--profile", help="comma-separated names of stages (trace spans, e.g. 'intoto.in_toto_verify,download') to run under cProfile, writing one .prof file per run of the stage", action="store")
+    parser.add_argument("--profile_dir", help="directory the --profile stats are written to (default: current directory)", default=".", action="store")
+    parser.add_argument("--serve", help="run a long-lived HTTP verification service (see README) instead of verifying once; --batch optionally provides per-repository defaults", action="store_true")
+    parser.add_argument("--host", help=f"address the service listens on (default: {server.DEFAULT_HOST})", default=server.DEFAULT_HOST, action="store")
+    parser.add_argument("--port", help=f"port the service listens on (default: {server.DEFAULT_PORT})", type=int, default=server.DEFAULT_PORT, action="store")
+    parser.add_argument("--server_workers", help=f"number of verifications the service runs at once (default: {server.DEFAULT_SERVER_WORKERS})", type=int, default=server.DEFAULT_SERVER_WORKERS, action="store")
+    parser.add_argument("--release_ttl", help=f"seconds the service reuses a repository's resolved latest release (default: {server.DEFAULT_RELEASE_TTL})", type=int, default=server.DEFAULT_RELEASE_TTL, action="store")
+    parser.add_argument("--api_token", help="token clients of the service authenticate POST /verify requests with, as 'Authorization: Bearer <token>' (default: $BRIDGE_API_TOKEN; /verify is disabled if unset)", default=os.getenv("BRIDGE_API_TOKEN"), action="store")
+    parser.add_argument("--webhook_secret", help="secret Github signs webhook deliveries to the service with (default: $WEBHOOK_SECRET; deliveries are not checked if unset)", default=os.getenv("WEBHOOK_SECRET"), action="store")
+    parser.add_argument("--watch", help="keep polling the repository (or every repository in --batch) and only verify releases that were not verified before, amending the policy at --output in place", action="store_true")
+    parser.add_argument("--interval", help=f"seconds between polls in watch mode (default: {watch.DEFAULT_INTERVAL})", type=int, default=watch.DEFAULT_INTERVAL, action="store")
+    parser.add_argument("--state_file", help=f"filepath of the watch mode state (default: {watch.DEFAULT_STATE_FILE})", default=watch.DEFAULT_STATE_FILE, action="store")
     args = parser.parse_args()
 
+    if args.trace or args.profile:
+        profile = [stage.strip() for stage in (args.profile or "").split(",") if stage.strip()]
+        trace.configure(args.trace, args.trace_format, profile, args.profile_dir)
+        atexit.register(trace.close)
+
     owner = args.owner
     repository = args.repository
     token = args.token
     if not token:
         token = os.getenv("GH_TOKEN")
+    tag = args.tag
     local_app_path = args.local_app_path
     destination_app_path = args.destination_app_path
+    layout_cache_dir = None if args.no_cache else args.layout_cache_dir
     intoto = {
         "layout_path": args.intoto,
         "layout_key": args.intoto_key,
-        "layout_key_password": args.intoto_key_password
+        "layout_key_password": args.intoto_key_password,
+        "layout_key_type": args.layout_key_type,
+        "layout_cache_dir": layout_cache_dir
     }
     sigstore_verify = args.sigstore
+    workers = args.workers
+    hash_algorithms = tuple(dict.fromkeys(a.strip() for a in args.ima_hash_algs.split(",") if a.strip()))
+    try:
+        download_algorithms = downloads.normalize_algorithms(hash_algorithms)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    # githubgql reads its endpoint from the environment on every request.
+    if args.github_graphql_url:
+        os.environ["GITHUB_GRAPHQL_URL"] = args.github_graphql_url
+    if args.rekor_url:
+        sigstore_shim.REKOR_URL = args.rekor_url
+    asset_cache = None if args.no_cache else cache.AssetCache(args.cache_dir, args.cache_max_size * 2**20)
+    if args.list_verified is not None:
+        list_verified(results.ResultStore(args.results_db, args.results_ttl * 3600), args)
+        return
+    if not args.no_cache:
+        results.configure(args.results_db, args.results_ttl * 3600, args.reverify)
+        atexit.register(results.close)
     allowlist = args.allowlist
+    store = policy_store.PolicyStore(args.policy_store) if args.policy_store else None
+    if store and not allowlist and store.latest_release() is not None:
+        allowlist = store.version_path(store.latest_release())
+    try:
+        excludelist = allowlists.load_excludelist(args.excludelist) if args.excludelist else None
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    output = args.output
     amended_policy = None
 
+    # When the policy goes to standard output, progress messages go to standard error.
+    if output == "-":
+        sys.stdout = sys.stderr
+    verified_digests = []
+
+    if args.apply_delta:
+        delta = policy_store.load_delta(args.apply_delta)
+        print(f"Applying delta from release {delta['from_release']} to release {delta['to_release']} onto {allowlist}")
+        try:
+            policy = policy_store.apply_delta(allowlists.get_allowlist(allowlist), delta)
+        except ValueError as e:
+            print(f"Could not apply delta: {e}")
+            sys.exit(1)
+        allowlists.save_allowlist(policy, output, args.gzip)
+        print(f"Policy written to {'standard output' if output == '-' else output}")
+        return
+
+    if args.tree:
+        index_path = None if args.no_cache else (args.tree_index or tree.default_index_path(args.tree))
+        tree_digests = tree.hash_tree(args.tree, download_algorithms, excludelist, index_path, args.tree_workers, args.tree_prefix)
+        if args.tree_link:
+            with open(args.tree_link, "r") as f:
+                products = json.load(f)["signed"]["products"]
+            report = tree.diff_against_products(tree_digests, products)
+            print(f"{report['matching']} of {len(products)} link products match {args.tree}")
+            for key in ("mismatched", "missing", "extra"):
+                for path in report[key]:
+                    print(f"{key.upper()} {path}")
+            if args.tree_report:
+                with open(args.tree_report, "w") as f:
+                    json.dump(report, f, indent=2)
+                print(f"Tree report written to {args.tree_report}")
+            if report["mismatched"] or report["missing"]:
+                sys.exit(1)
+            return
+        if allowlist:
+            print(f"Using existing allowlist present at {allowlist}")
+        policy = tree.add_to_allowlist(allowlists.get_allowlist(allowlist, excludelist), tree_digests, hash_algorithms, args.tree_prefix)
+        save_policy(policy, args, store)
+        return
+
+    if args.serve:
+        if not token:
+            print("--token is required to serve verifications")
+            sys.exit(1)
+        entries = batch.load_manifest(args.batch) if args.batch else []
+        if allowlist:
+            print(f"Using existing allowlist present at {allowlist}")
+        policy = allowlists.get_allowlist(output if os.path.exists(output) else allowlist, excludelist)
+        with downloads.Downloader(workers, asset_cache, download_algorithms, args.download_segments, args.download_retries) as downloader:
+            service = server.VerificationService(token, downloader, policy, output, entries, args.server_workers, args.release_ttl,
+                hash_algorithms=hash_algorithms, excludelist=excludelist, compress=args.gzip, store=store, retire_after=args.retire_after, layout_cache_dir=layout_cache_dir)
+            # http.server is only loaded by runs that serve the HTTP API.
+            from source import http_api
+            httpd = http_api.make_server(service, args.host, args.port, args.webhook_secret, args.api_token)
+            print(f"Serving verifications on http://{args.host}:{httpd.server_address[1]}, policy kept in {output}")
+            if not args.api_token:
+                print("WARNING: POST /verify is disabled until an --api_token is set")
+            try:
+                httpd.serve_forever()
+            except KeyboardInterrupt:
+                print("Stopped serving")
+            finally:
+                httpd.server_close()
+                service.close()
+        return
+
+    if args.watch:
+        if not token or not (args.batch or (owner and repository)):
+            print("--token and either --batch or both --owner and --repository are required to watch Github releases")
+            sys.exit(1)
+        if args.batch:
+            entries = batch.load_manifest(args.batch)
+        else:
+            entries = [{
+                "owner": owner,
+                "repository": repository,
+                "tag": tag,
+                "destination_app_path": destination_app_path,
+                "local_app_path": local_app_path,
+                "intoto": args.intoto,
+                "intoto_key": args.intoto_key,
+                "intoto_key_password": args.intoto_key_password,
+                "layout_key_type": args.layout_key_type,
+                "sigstore": sigstore_verify,
+            }]
+        print(f"Watching {len(entries)} repositories every {args.interval} seconds, state kept in {args.state_file}")
+        with downloads.Downloader(workers, asset_cache, download_algorithms, args.download_segments, args.download_retries) as downloader:
+            try:
+                watch.watch(entries, token, downloader, output, args.state_file, args.interval, allowlist, args.graphql_batch_size, args.gzip, store, args.retire_after, excludelist, hash_algorithms, layout_cache_dir)
+            except KeyboardInterrupt:
+                print("Stopped watching")
+        return
+
     print("""
      --- SUPPLY CHAIN BRIDGE ---
 
@@ -50,13 +229,29 @@ def main():
 
     """)
 
-    if owner and repository and token:
-        verified_hashes = artifacts.fetch_verified_hashes(owner, repository, token, local_app_path, sigstore_verify, intoto)
+    if args.batch and token:
+        entries = batch.load_manifest(args.batch)
+        if allowlist:
+            print(f"Using existing allowlist present at {allowlist}")
+        with downloads.Downloader(workers, asset_cache, download_algorithms, args.download_segments, args.download_retries) as downloader:
+            amended_policy, report = batch.run_batch(entries, token, downloader, allowlists.get_allowlist(allowlist, excludelist), args.jobs, args.graphql_batch_size, excludelist, hash_algorithms, layout_cache_dir)
+        batch.print_report(report)
+        if args.batch_report:
+            with open(args.batch_report, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"Batch report written to {args.batch_report}")
+    elif owner and repository and token:
+        try:
+            with downloads.Downloader(workers, asset_cache, download_algorithms, args.download_segments, args.download_retries) as downloader:
+                verified_digests = artifacts.fetch_verified_digests(owner, repository, token, local_app_path, sigstore_verify, intoto, downloader, tag)
+        except artifacts.VerificationError as e:
+            print(f"Verification failed! {e}")
+            sys.exit(1)
         print(f"Verified hashes for {owner}/{repository}:")
-        for hash in verified_hashes:
-            print(hash)
+        for digests in verified_digests:
+            print(" ".join(digests[a] for a in hash_algorithms))
     else:
-        print("--owner, --repository, and --token are all required to fetch artifacts from Github")
+        print("--token and either --batch or both --owner and --repository are required to fetch artifacts from Github")
 
     print("""
 
@@ -64,17 +259,18 @@ def main():
 
     """)
 
-    if destination_app_path:
-        verified_hash = verified_hashes[0]
+    if destination_app_path and verified_digests and excludelist and excludelist.matches(destination_app_path):
+        print(f"Destination path {destination_app_path} matches the excludelist, not adding it to the allowlist")
+        amended_policy = allowlists.get_allowlist(allowlist, excludelist)
+    elif destination_app_path and verified_digests:
+        verified_hash = ", ".join(verified_digests[0][a] for a in hash_algorithms)
         print(f"Adding verified hash {verified_hash} to allowlist with destination path {destination_app_path}")
         if allowlist:
             print(f"Using existing allowlist present at {allowlist}")
-        amended_policy = allowlists.append_path_to_allowlist(allowlists.get_allowlist(allowlist), destination_app_path, verified_hash)
+        amended_policy = allowlists.append_digests_to_allowlist(allowlists.get_allowlist(allowlist, excludelist), destination_app_path, verified_digests[0], hash_algorithms)
 
-    if amended_policy:
-        with open("keylime-policy.json", "w") as f:
-           f.write(json.dumps(amended_policy))
-        print("Amended policy written to keylime-policy.json")
+    if amended_policy is not None:
+        save_policy(amended_policy, args, store)
 
     print("""
 
@@ -82,5 +278,29 @@ def main():
 
     """)
 
+# Commits policy to the policy store (writing the delta from the previous
+# version if requested), then writes it to --output.
+def save_policy(policy, args, store=None):
+    if store:
+        previous_release = store.latest_release()
+        release = store.commit(policy, args.retire_after)
+        print(f"Policy stored as release {release} in {args.policy_store}")
+        if args.delta_output and previous_release is not None:
+            policy_store.save_delta(store.delta(previous_release, release), args.delta_output)
+            print(f"Delta from release {previous_release} written to {args.delta_output}")
+
+    allowlists.save_allowlist(policy, args.output, args.gzip)
+    print(f"Amended policy written to {'standard output' if args.output == '-' else args.output}")
+
+# Prints the stored verification results matching --list_verified, --owner/--repository and --tag.
+def list_verified(store, args):
+    repository = f"{args.owner}/{args.repository}" if args.owner and args.repository else None
+    rows = store.list(repository, args.tag, args.list_verified)
+    for row in rows:
+        verified_at = datetime.datetime.fromtimestamp(row["verified_at"]).strftime("%Y-%m-%d %H:%M:%S")
+        outcome = "PASS" if row["passed"] else "FAIL"
+        print(f"{verified_at} {outcome} {row['step']:<9} {row['mode']:<14} {row['repository']} {row['tag'] or '-'} {row['artifact']} {row['sha256']}")
+    print(f"{len(rows)} stored results in {store.path}")
+
 if __name__ == "__main__":
    main()
@@ -1,54 +1,467 @@
-import copy, datetime, json, re
+import copy, datetime, gzip, json, os, re, sys, tempfile
 from .constants import constants
 
-# Looks for allowlists at allowlist_path, converts it to new JSON format if necessary, then returns.
-def get_allowlist(allowlist_path=None):
-    if allowlist_path:
-        with open(allowlist_path, "r") as f:
-            alist_raw = f.read()
+# Number of bytes read, and of hash entries serialized, at a time when streaming
+# JSON allowlists in and out.
+READ_CHUNK_SIZE = 1024 * 1024
+WRITE_BATCH_SIZE = 10000
+# Hex digests stored in compact form.
+LOWER_HEX = re.compile(r"(?:[0-9a-f]{2})*")
+# Inline flags applying to a whole regular expression, e.g. (?i).
+GLOBAL_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+
+# Keylime allowlist indexed by path. Hashes are deduplicated per path and kept
+# compact in memory: lowercase hex digests (what Keylime and the hashers here
+# produce) are stored as raw bytes and other hashes as given, a single value
+# for the common one-hash path and a tuple when a path has several, so
+# multi-million-entry allowlists stay small. Every hash is written back exactly
+# as it was read. Every other section of the allowlist (meta, release,
+# keyrings, ima...) is kept as-is in document.
+class Allowlist:
+    def __init__(self, document=None):
+        if document is None:
+            document = copy.deepcopy(constants.EMPTY_ALLOWLIST)
+        hashes = document.get("hashes") or {}
+        # The hashes key is kept as a placeholder so it serializes in its original position.
+        document["hashes"] = None
+        self.document = document
+        self.document.setdefault("keyrings", {})
+        self.hashes = {}
+        for path, hash_list in hashes.items():
+            for hash in hash_list:
+                self.add(path, hash)
+
+    def __len__(self):
+        return len(self.hashes)
 
-        p = re.compile(r"^\s*{")
-        if p.match(alist_raw):
-            alist = json.loads(alist_raw)
+    def __contains__(self, path):
+        return path in self.hashes
+
+    # Adds hash for path unless already present. Returns whether it was added.
+    def add(self, path, hash):
+        digest = _pack(hash)
+        current = self.hashes.get(path)
+        if current is None:
+            self.hashes[path] = digest
+            return True
+        if isinstance(current, tuple):
+            if digest in current:
+                return False
+            self.hashes[path] = current + (digest,)
         else:
-            alist = copy.deepcopy(constants.EMPTY_ALLOWLIST)
-            alist["meta"]["timestamp"] = str(datetime.datetime.now())
-            alist["meta"]["generator"] = "keylime-legacy-format-upgrade"
+            if digest == current:
+                return False
+            self.hashes[path] = (current, digest)
+        return True
 
-            for line in alist_raw.splitlines():
-                line = line.strip()
-                if len(line) == 0:
-                    continue
+    # Removes hash from the allowed hashes of path, and path itself once it has
+    # no hashes left. Returns whether it was removed.
+    def remove(self, path, hash):
+        digest = _pack(hash)
+        current = self.hashes.get(path)
+        if current is None:
+            return False
+        if isinstance(current, tuple):
+            if digest not in current:
+                return False
+            remaining = tuple(d for d in current if d != digest)
+            self.hashes[path] = remaining if len(remaining) > 1 else remaining[0]
+        else:
+            if digest != current:
+                return False
+            del self.hashes[path]
+        return True
 
-                pieces = line.split(None, 1)
-                if not len(pieces) == 2:
-                    print("Line in Allowlist does not consist of hash and file path: %s", line)
-                    continue
+    # Adds many (path, hash) pairs at once. Returns the number of hashes added.
+    def merge(self, pairs):
+        added = 0
+        for path, hash in pairs:
+            added += self.add(path, hash)
+        return added
 
-                (checksum_hash, path) = pieces
+    # Adds hash to the keyring named keyring unless already present.
+    def add_keyring(self, keyring, hash):
+        hashes = self.document["keyrings"].setdefault(keyring, [])
+        if hash not in hashes:
+            hashes.append(hash)
 
-                if path.startswith("%keyring:"):
-                    entrytype = "keyrings"
-                    path = path[len("%keyring:") :]  # remove leading '%keyring:' from path to get keyring name
-                else:
-                    entrytype = "hashes"
+    # Returns the hex hashes allowed for path.
+    def get(self, path):
+        current = self.hashes.get(path)
+        if current is None:
+            return []
+        if isinstance(current, tuple):
+            return [_unpack(d) for d in current]
+        return [_unpack(current)]
 
-                if path in alist[entrytype]:
-                    alist[entrytype][path].append(checksum_hash)
-                else:
-                    alist[entrytype][path] = [checksum_hash]
+    # Yields (path, [hex hashes]) for every path in the allowlist.
+    def items(self):
+        for path in self.hashes:
+            yield path, self.get(path)
+
+    # Returns the allowlist as a plain JSON-serializable dictionary.
+    def to_dict(self):
+        document = dict(self.document)
+        document["hashes"] = dict(self.items())
+        return document
+
+# Keylime excludelist: paths matching any of its regular expressions (anchored
+# at the start of the path, as Keylime does) are not measured. All patterns are
+# compiled into a single alternation, split per leading directory: a pattern
+# starting with a literal directory such as /usr/ only joins the matcher for
+# paths under that directory, so each path is tested against one or two
+# compiled expressions however many patterns there are. Flags a pattern sets
+# for itself, such as a leading (?i), are scoped to that pattern.
+class Excludelist:
+    def __init__(self, patterns=()):
+        self.patterns = []
+        for pattern in patterns:
+            if pattern not in self.patterns:
+                self.patterns.append(pattern)
+
+        by_directory = {}
+        generic = []
+        for pattern in self.patterns:
+            directory = _leading_directory(pattern)
+            if directory:
+                by_directory.setdefault(directory, []).append(_scope_flags(pattern))
+            else:
+                generic.append(_scope_flags(pattern))
+        self._generic = _combine(generic)
+        # Patterns that can match anywhere also apply under every directory.
+        self._by_directory = {directory: _combine(directory_patterns + generic) for directory, directory_patterns in by_directory.items()}
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def matches(self, path):
+        end = path.find("/", 1) + 1
+        matcher = self._by_directory.get(path[:end], self._generic) if end else self._generic
+        return matcher is not None and matcher.match(path) is not None
+
+# Reads the excludelist at excludelist_path: one regular expression per line,
+# skipping blank lines and # comments.
+def load_excludelist(excludelist_path):
+    with _open_text(excludelist_path, "r") as f:
+        patterns = [line.strip() for line in f]
+    return Excludelist([p for p in patterns if p and not p.startswith("#")])
+
+# Adds the patterns of excludelist to the excludes section of alist.
+def add_excludes(alist, excludelist):
+    excludes = alist.document.setdefault("excludes", [])
+    for pattern in excludelist.patterns:
+        if pattern not in excludes:
+            excludes.append(pattern)
+    return alist
+
+# Looks for allowlists at allowlist_path, converts it to new JSON format if necessary, then returns.
+# JSON allowlists are parsed incrementally, and gzip-compressed (.gz) allowlists are accepted.
+# Paths of legacy allowlists matching excludelist are left out, and its patterns
+# are recorded in the excludes section of the returned allowlist.
+def get_allowlist(allowlist_path=None, excludelist=None):
+    if allowlist_path:
+        with _open_text(allowlist_path, "r") as f:
+            if _starts_with_json_object(f):
+                alist = read_allowlist_json(f)
+            else:
+                alist = Allowlist()
+                alist.document["meta"]["timestamp"] = str(datetime.datetime.now())
+                alist.document["meta"]["generator"] = "keylime-legacy-format-upgrade"
+                _parse_legacy(f, alist, excludelist)
     else:
-        alist = copy.deepcopy(constants.EMPTY_ALLOWLIST)
-        alist["meta"]["timestamp"] = str(datetime.datetime.now())
-        alist["meta"]["generator"] = "keylime-policy-importer"
+        alist = Allowlist()
+        alist.document["meta"]["timestamp"] = str(datetime.datetime.now())
+        alist.document["meta"]["generator"] = "keylime-policy-importer"
+    if excludelist:
+        add_excludes(alist, excludelist)
     return alist
 
-# Reads an in-toto .link file present at link_path and converts it to a Keylime
-# policy, or appends to an existing policy if provided.
+# Appends hash to the allowed hashes of path, skipping duplicates.
 def append_path_to_allowlist(alist, path, hash):
-    entrytype = "hashes"
-    if path in alist[entrytype]:
-        alist[entrytype][path].append(hash)
+    alist.add(path, hash)
+    return alist
+
+# Appends the digests ({algorithm: hex digest}) of path in each of algorithms
+# to its allowed hashes, skipping duplicates.
+def append_digests_to_allowlist(alist, path, digests, algorithms=("sha256",)):
+    for algorithm in algorithms:
+        alist.add(path, digests[algorithm])
+    return alist
+
+# Adds many (path, hash) pairs to alist at once, skipping duplicates.
+def merge_into_allowlist(alist, pairs):
+    alist.merge(pairs)
+    return alist
+
+# Incrementally reads a JSON allowlist from f. The hashes section is added to the
+# allowlist entry by entry, so the file is never held in memory as a whole.
+def read_allowlist_json(f):
+    stream = _JSONStream(f)
+    alist = Allowlist({"hashes": {}})
+    document = {}
+
+    stream.expect("{")
+    if stream.peek() == "}":
+        stream.expect("}")
     else:
-        alist[entrytype][path] = [hash]
+        while True:
+            key = stream.value()
+            stream.expect(":")
+            if key == "hashes":
+                document["hashes"] = None
+                stream.expect("{")
+                if stream.peek() == "}":
+                    stream.expect("}")
+                else:
+                    while True:
+                        entry = stream.simple_entry()
+                        if entry:
+                            path, hash, more = entry
+                            alist.add(path, hash)
+                            if more:
+                                continue
+                        else:
+                            path = stream.value()
+                            stream.expect(":")
+                            for hash in stream.value():
+                                alist.add(path, hash)
+                        if stream.peek() != ",":
+                            stream.expect("}")
+                            break
+                        stream.expect(",")
+            else:
+                document[key] = stream.value()
+            if stream.peek() != ",":
+                stream.expect("}")
+                break
+            stream.expect(",")
+
+    document.setdefault("hashes", None)
+    document.setdefault("keyrings", {})
+    alist.document = document
     return alist
+
+# Writes alist to f as JSON section by section, and the hashes section in
+# batches of entries, without building the whole document in memory. The
+# output is byte-for-byte what json.dumps(alist.to_dict()) produces.
+def write_allowlist_json(alist, f):
+    f.write("{")
+    for i, (key, value) in enumerate(alist.document.items()):
+        if i:
+            f.write(", ")
+        f.write(f"{json.dumps(key)}: ")
+        if key == "hashes":
+            _write_hashes(alist, f)
+        else:
+            f.write(json.dumps(value))
+    f.write("}")
+
+# Writes alist to output_path ("-" for standard output), gzip-compressed if
+# compress is set or output_path ends in .gz. Files are replaced atomically.
+def save_allowlist(alist, output_path, compress=False):
+    compress = compress or output_path.endswith(".gz")
+    if output_path == "-":
+        if compress:
+            with gzip.open(sys.__stdout__.buffer, "wt") as f:
+                write_allowlist_json(alist, f)
+        else:
+            write_allowlist_json(alist, sys.__stdout__)
+            sys.__stdout__.flush()
+        return
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_path)), suffix=".tmp")
+    os.close(fd)
+    try:
+        with _open_text(tmp_path, "w", compress) as f:
+            write_allowlist_json(alist, f)
+        # mkstemp creates files readable only by their owner; keep the mode of
+        # the file being replaced, or the one a new file would get, so Keylime
+        # can still read the policy.
+        os.chmod(tmp_path, _file_mode(output_path))
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# Returns the permission bits of the file at path, or those a newly created file
+# gets under the current umask if there is none.
+def _file_mode(path):
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        return 0o666 & ~umask
+
+def _write_hashes(alist, f):
+    encode = json.encoder.encode_basestring_ascii
+    f.write("{")
+    entries = []
+    first = True
+    for path, digest in alist.hashes.items():
+        # Single hex digests are by far the most common entry and need no escaping.
+        if isinstance(digest, bytes):
+            entries.append(f'{encode(path)}: ["{digest.hex()}"]')
+        else:
+            entries.append(f"{encode(path)}: {json.dumps(alist.get(path))}")
+        if len(entries) == WRITE_BATCH_SIZE:
+            f.write(("" if first else ", ") + ", ".join(entries))
+            entries = []
+            first = False
+    if entries:
+        f.write(("" if first else ", ") + ", ".join(entries))
+    f.write("}")
+
+def _open_text(path, mode, compress=None):
+    if compress or (compress is None and path.endswith(".gz")):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+# Minimal incremental JSON tokenizer over a text file, decoding one value at a
+# time from a buffer that is refilled in READ_CHUNK_SIZE pieces.
+class _JSONStream:
+    # Fast path for the common `"path": ["hexdigest"]` entry without escapes,
+    # along with the comma following it, if any.
+    SIMPLE_ENTRY = re.compile(r'\s*"([^"\\]*)"\s*:\s*\[\s*"([0-9a-fA-F]*)"\s*\]\s*(,?)')
+    # Characters that can continue a JSON number.
+    NUMBER_CONTINUATION = frozenset("0123456789.eE+-")
+
+    def __init__(self, f):
+        self.f = f
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        chunk = self.f.read(READ_CHUNK_SIZE)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.eof = not chunk
+
+    def peek(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self._fill()
+
+    def expect(self, c):
+        if self.peek() != c:
+            raise ValueError(f"Malformed JSON allowlist: expected {c!r}, found {self.peek()!r}")
+        self.pos += 1
+
+    # Returns (path, hash, whether a comma followed) if the next hashes entry is
+    # a simple one, else None.
+    def simple_entry(self):
+        match = self.SIMPLE_ENTRY.match(self.buf, self.pos)
+        if match is None or match.end() == len(self.buf):
+            return None
+        self.pos = match.end()
+        return match.group(1), match.group(2), bool(match.group(3))
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                # A number split by the end of the buffer decodes as its first
+                # part (e.g. "1." or "1e" as 1), so it is only accepted once
+                # nothing that could continue it follows.
+                if self.eof or not (_is_number(obj) and (end == len(self.buf) or self.buf[end] in self.NUMBER_CONTINUATION)):
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+def _is_number(obj):
+    return isinstance(obj, (int, float)) and not isinstance(obj, bool)
+
+# Streams a legacy-format allowlist ("<hash> <path>" per line) from f into
+# alist, skipping paths matching excludelist.
+def _parse_legacy(f, alist, excludelist=None):
+    for line in f:
+        line = line.strip()
+        if len(line) == 0:
+            continue
+
+        pieces = line.split(None, 1)
+        if not len(pieces) == 2:
+            print("Line in Allowlist does not consist of hash and file path: %s", line)
+            continue
+
+        (checksum_hash, path) = pieces
+
+        if path.startswith("%keyring:"):
+            alist.add_keyring(path[len("%keyring:") :], checksum_hash)  # remove leading '%keyring:' from path to get keyring name
+        elif excludelist and excludelist.matches(path):
+            continue
+        else:
+            alist.add(path, checksum_hash)
+
+# Returns whether the first non-whitespace character of f opens a JSON object,
+# leaving f at its start.
+def _starts_with_json_object(f):
+    while True:
+        c = f.read(1)
+        if not c or not c.isspace():
+            break
+    f.seek(0)
+    return c == "{"
+
+# Returns the literal leading directory (e.g. "/usr/") every path matched by
+# pattern starts with, or None if the pattern does not start with one.
+def _leading_directory(pattern):
+    if "|" in pattern:
+        return None
+    pattern = pattern[1:] if pattern.startswith("^") else pattern
+    prefix = ""
+    for c in pattern:
+        if c in "*+?{":
+            # The quantifier makes the preceding character optional or repeatable.
+            prefix = prefix[:-1]
+            break
+        if c in ".^$[]\\()":
+            break
+        prefix += c
+    end = prefix.find("/", 1) + 1 if prefix.startswith("/") else 0
+    return prefix[:end] if end else None
+
+# Returns pattern with its leading global inline flags, e.g. (?i), turned into a
+# group scoped to the pattern, so that they cannot apply to the other patterns
+# of a combined expression. Raises ValueError if pattern is not a valid regular
+# expression or sets global flags anywhere else.
+def _scope_flags(pattern):
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        raise ValueError(f"Invalid excludelist pattern {pattern!r}: {e}") from e
+    flags = ""
+    rest = pattern
+    while (match := GLOBAL_FLAGS.match(rest)):
+        flags += match.group(1)
+        rest = rest[match.end():]
+    if not flags:
+        if compiled.flags & ~re.UNICODE:
+            raise ValueError(f"Invalid excludelist pattern {pattern!r}: global flags must be at its start, or use a scoped group such as (?i:...)")
+        return pattern
+    # A trailing comment of a verbose pattern must not swallow the closing parenthesis.
+    return f"(?{flags}:{rest}\n)" if "x" in flags else f"(?{flags}:{rest})"
+
+def _combine(patterns):
+    if not patterns:
+        return None
+    return re.compile("|".join(f"(?:{p})" for p in patterns))
+
+# Only lowercase hex digests are stored as bytes; anything else (e.g. uppercase
+# hex) is kept as given, so every hash is written back exactly as it was read.
+def _pack(hash):
+    if LOWER_HEX.fullmatch(hash):
+        return bytes.fromhex(hash)
+    return hash
+
+def _unpack(digest):
+    return digest.hex() if isinstance(digest, bytes) else digest
@@ -1,66 +1,235 @@
-import hashlib
 import json
 import os
-import sys
-import requests
-from . import github, signing, intoto_tools
+from . import downloads, github, results, signing, intoto_tools, trace
 
-def fetch_verified_hashes(owner, repo, token, local_app_path=None, sigstore_verify=False, intoto=None):
-    artifact_urls, link_urls, id_key_urls = github.fetch_links_from_github(owner, repo, token)
+# Raised when an artifact fails any of the verification steps.
+class VerificationError(Exception):
+    pass
+
+# Verifies the assets of the latest (or tagged) release of owner/repo and returns
+# their verified SHA-256 hashes. links may provide the release's already-resolved
+# (artifact_urls, link_urls, id_key_urls), e.g. from github.organize_assets, in
+# which case tag should be the tag of that release.
+def fetch_verified_hashes(owner, repo, token, local_app_path=None, sigstore_verify=False, intoto=None, downloader=None, tag=None, links=None):
+    verified_digests = fetch_verified_digests(owner, repo, token, local_app_path, sigstore_verify, intoto, downloader, tag, links)
+    return [digests["sha256"] for digests in verified_digests]
+
+# Same as fetch_verified_hashes, but returns the verified digests of every
+# artifact in all algorithms of downloader ({algorithm: hex digest}), each
+# artifact having been read once.
+def fetch_verified_digests(owner, repo, token, local_app_path=None, sigstore_verify=False, intoto=None, downloader=None, tag=None, links=None):
+    if downloader is None:
+        with downloads.Downloader() as downloader:
+            return fetch_verified_digests(owner, repo, token, local_app_path, sigstore_verify, intoto, downloader, tag, links)
+
+    with trace.span("verify_release", owner=owner, repo=repo, tag=tag):
+        return _verify_release(owner, repo, token, local_app_path, sigstore_verify, intoto, downloader, tag, links)
+
+def _verify_release(owner, repo, token, local_app_path, sigstore_verify, intoto, downloader, tag, links):
+    if links is None:
+        with trace.span("github.fetch_release", owner=owner, repo=repo):
+            release = github.fetch_release(owner, repo, token, tag)
+        # Results are recorded under the release actually verified, also when
+        # the latest one was asked for.
+        tag = release["tag"]
+        links = github.organize_assets(release["assets"])
+    artifact_urls, link_urls, id_key_urls = links
+
+    # Queue every asset this run needs up front so they download concurrently.
+    # Remote binaries are spooled to disk and hashed while downloading, so they
+    # are never held in memory as a whole.
+    local_digests = None
+    for artifact_name, artifact_signing_materials in artifact_urls.items():
+        if local_app_path and os.path.basename(local_app_path) == artifact_name:
+            local_digests = downloader.hash_local(local_app_path)
+        else:
+            artifact_url = artifact_signing_materials["artifact"]
+            downloader.prefetch([artifact_url], {artifact_url: artifact_signing_materials.get("size")})
+        downloader.prefetch([artifact_signing_materials["sig"], artifact_signing_materials["crt"]])
+    if intoto:
+        downloader.prefetch([link["url"] for link in link_urls.values()])
+    if intoto and intoto["layout_path"] != "simple":
+        downloader.prefetch([key["url"] for key in id_key_urls.values()])
 
     binaries = {}
-    verified_hashes = []
+    binary_hashes = {}
+    binary_digests = {}
+    signing_materials = {}
+    verified_digests = []
     for artifact_name in artifact_urls.keys():
         artifact_signing_materials = artifact_urls[artifact_name]
-        if local_app_path and os.path.basename(local_app_path) == artifact_name:
-            print(f"{artifact_name}: Verifying local binary at {local_app_path} against signing materials from {owner}/{repo}")
-            with open(local_app_path, "rb") as f:
-                artifact_raw = f.read()
-        else:
-            print(f"{artifact_name}: Verifying remote binary from {owner}/{repo} against signing materials from {owner}/{repo}")
-            artifact_raw = requests.get(artifact_signing_materials["artifact"]).content
+        with trace.span("artifact.wait_for_download", artifact=artifact_name):
+            if local_app_path and os.path.basename(local_app_path) == artifact_name:
+                print(f"{artifact_name}: Verifying local binary at {local_app_path} against signing materials from {owner}/{repo}")
+                artifact_path = local_app_path
+                artifact_digests = local_digests.result()
+                artifact_hash = artifact_digests["sha256"]
+            else:
+                print(f"{artifact_name}: Verifying remote binary from {owner}/{repo} against signing materials from {owner}/{repo}")
+                artifact_path, artifact_digests = downloader.spool_digests(artifact_signing_materials["artifact"])
+                artifact_hash = artifact_digests["sha256"]
+                if artifact_signing_materials.get("sha256") not in (None, artifact_hash):
+                    raise VerificationError(f"{artifact_name}: downloaded binary does not match the digest reported by Github")
+
+            sig_raw = downloader.fetch(artifact_signing_materials["sig"])
+            crt_raw = downloader.fetch(artifact_signing_materials["crt"])
+
+        binaries[artifact_name] = artifact_path
+        binary_hashes[artifact_name] = artifact_hash
+        binary_digests[artifact_name] = artifact_digests
+        signing_materials[artifact_name] = (artifact_hash, sig_raw, crt_raw)
+
+    # Steps that already passed on exactly the same inputs (see results.ResultStore)
+    # are not run again. Per-artifact results are keyed by the digests of the
+    # binary, its signature and its certificate.
+    store = results.get_store()
+    repository = f"{owner}/{repo}"
+    inputs = {artifact_name: [artifact_hash, results.digest(sig_raw), results.digest(crt_raw)]
+              for artifact_name, (artifact_hash, sig_raw, crt_raw) in signing_materials.items()}
 
-        sig_response = requests.get(artifact_signing_materials["sig"])
-        crt_response = requests.get(artifact_signing_materials["crt"])
+    def reusable(step, mode, artifact_names, step_inputs=inputs):
+        if not store:
+            return set()
+        reused = {artifact_name for artifact_name in artifact_names if store.passed(step, mode, step_inputs[artifact_name])}
+        if reused:
+            print(f"Reusing {step} results of {len(reused)} artifacts verified before")
+        return reused
 
-        if not signing.verify_hash_with_cert(artifact_raw, sig_response.content, crt_response.content):
-            sys.exit(1)
+    def record(step, mode, artifact_name, passed, step_inputs=inputs, expires_at=None):
+        if store:
+            store.record(step, mode, step_inputs[artifact_name], passed, repository, tag, artifact_name, binary_hashes[artifact_name], expires_at)
 
-        if sigstore_verify:
+    # Signatures of the whole release are checked concurrently, and every
+    # failing artifact is reported rather than only the first one.
+    reused = reusable("signature", "signature", signing_materials)
+    signature_failures = signing.verify_signatures({n: m for n, m in signing_materials.items() if n not in reused})
+    for artifact_name, failure in signature_failures.items():
+        record("signature", "signature", artifact_name, not failure)
+        if failure:
+            print(f"{artifact_name}: Artifact signature validation failed: {failure}")
+        else:
+            print(f"{artifact_name}: Artifact signature validation passed!")
+    failed = [artifact_name for artifact_name, failure in signature_failures.items() if failure]
+    if failed:
+        raise VerificationError(f"{', '.join(failed)}: artifact signature validation failed")
+
+    if sigstore_verify:
+        reused = reusable("sigstore", "sigstore", signing_materials)
+        for artifact_name, (artifact_hash, sig_raw, crt_raw) in signing_materials.items():
+            if artifact_name in reused:
+                continue
             print(f"{artifact_name}: Verifying presence of valid signature and inclusion proof against Rekor...")
-            if signing.verify_sigstore_python(artifact_raw, sig_response.content, crt_response.content):
+            with trace.span("artifact.verify_sigstore", artifact=artifact_name):
+                sigstore_verified = signing.verify_sigstore_python(binaries[artifact_name], sig_raw, crt_raw)
+            record("sigstore", "sigstore", artifact_name, sigstore_verified)
+            if sigstore_verified:
                 print("Sigstore validation passed!")
             else:
                 print("Sigstore validation failed!")
-                sys.exit(1)
+                raise VerificationError(f"{artifact_name}: Sigstore validation failed")
 
-        binaries[artifact_name] = artifact_raw
+    # Inclusion proofs of the whole release are checked against Rekor in one batch.
+    if sigstore_verify:
+        reused = reusable("rekor", "sigstore", signing_materials)
+        pending = {n: m for n, m in signing_materials.items() if n not in reused}
+        if pending:
+            print(f"Verifying Rekor inclusion proofs for {len(pending)} artifacts...")
+            with trace.span("rekor.verify_inclusion_proofs", artifacts=len(pending)):
+                inclusion = signing.verify_inclusion_proofs(pending)
+            for artifact_name, included in inclusion.items():
+                record("rekor", "sigstore", artifact_name, included)
+            for artifact_name, included in inclusion.items():
+                if not included:
+                    raise VerificationError(f"{artifact_name}: Rekor inclusion proof verification failed")
 
     if intoto:
         if intoto["layout_path"] == "simple":
-            print(f"{artifact_name}: Performing simple in-toto linkfile verification")
-            link_response = requests.get(link_urls["compile"]["url"])
-            paths = json.loads(link_response.content)["signed"]["products"]
-            link_hashes = [paths[p]["sha256"] for p in paths]
-            for binary in binaries.values():
-                binary_hash = hashlib.sha256(binary).hexdigest()
-                if binary_hash in link_hashes:
-                    verified_hashes += [binary_hash]
+            print(f"Performing simple in-toto linkfile verification against {len(link_urls)} links")
+            if not link_urls:
+                raise VerificationError("the release has no in-toto links to verify against")
+            # Every step's products and materials are indexed by SHA-256, so
+            # each binary is looked up once per link rather than compared
+            # against every product.
+            link_digests = {}
+            indexes = []
+            with trace.span("intoto.wait_for_link", links=len(link_urls)):
+                for step, link in link_urls.items():
+                    link_path, link_digests[step] = downloader.spool(link["url"])
+                    indexes.append(intoto_tools.index_link(link_path, link_digests[step]))
+            # Matching digests against the index is cheaper than looking up a
+            # stored result, so simple results are only recorded.
+            link_inputs = {artifact_name: [binary_hashes[artifact_name], sorted(link_digests.values())] for artifact_name in binary_hashes}
+            for artifact_name, binary_hash in binary_hashes.items():
+                entries = [entry for index in indexes for entry in index.get(binary_hash, ())]
+                producers = sorted({step for step, role, _, _ in entries if role == "products"})
+                if not producers:
+                    continue
+                # Cross-check every other algorithm the matching products and materials record.
+                for step, role, path, digests in entries:
+                    for algorithm, digest in binary_digests[artifact_name].items():
+                        if digests.get(algorithm, digest) != digest:
+                            record("intoto", "simple", artifact_name, False, link_inputs)
+                            raise VerificationError(f"{artifact_name}: {algorithm} digest does not match {path} in the {role} of step {step}")
+                consumers = sorted({step for step, role, _, _ in entries if role == "materials"})
+                print(f"{artifact_name}: Produced by step {', '.join(producers)}" + (f", consumed by step {', '.join(consumers)}" if consumers else ""))
+                record("intoto", "simple", artifact_name, True, link_inputs)
+                verified_digests += [binary_digests[artifact_name]]
         else:
             print(f"{artifact_name}: Verifying full in-toto supply chain layout")
-            if intoto["layout_path"] != "default-layout":
+            if intoto["layout_path"] not in (None, "default-layout"):
                 print(f"Using in-toto layout definition at {intoto['layout_path']}")
             else:
                 intoto["layout_path"] = None
             try:
-                intoto_tools.verify_layout(binaries, link_urls, id_key_urls, intoto)
-            except Exception as e:
-                print(f"in-toto verification failed! Exception: {e}")
-                sys.exit(1)
+                mode, layout_inputs, layout_expires_at = _layout_inputs(binary_hashes, link_urls, id_key_urls, intoto, downloader)
+            except (OSError, ValueError) as e:
+                raise VerificationError(f"in-toto verification failed: {e}") from e
+            layout_inputs = {artifact_name: layout_inputs + [artifact_name] for artifact_name in binary_hashes}
+            if reusable("intoto", mode, binary_hashes, layout_inputs) != set(binary_hashes):
+                try:
+                    with trace.span("intoto.verify_layout", artifacts=len(binaries)):
+                        intoto_tools.verify_layout(binaries, link_urls, id_key_urls, intoto, downloader)
+                except Exception as e:
+                    print(f"in-toto verification failed! Exception: {e}")
+                    for artifact_name in binary_hashes:
+                        record("intoto", mode, artifact_name, False, layout_inputs)
+                    raise VerificationError(f"in-toto verification failed: {e}") from e
+                for artifact_name in binary_hashes:
+                    record("intoto", mode, artifact_name, True, layout_inputs, layout_expires_at)
 
-            verified_hashes += [hashlib.sha256(b).hexdigest() for b in binaries.values()]
+            verified_digests += list(binary_digests.values())
     else:
         print("WARNING: `-i` or `--intoto` not supplied, skipping in-toto verification")
-        verified_hashes += [hashlib.sha256(b).hexdigest() for b in binaries.values()]
+        verified_digests += list(binary_digests.values())
 
-    return verified_hashes
+    return verified_digests
+
+# Returns the mode and the inputs of a full in-toto layout verification: the
+# digests of every artifact, link and functionary key, and of the custom layout
+# and its key, or the key type the default layout is generated with. Also
+# returns when a custom layout expires (a Unix timestamp), as a result checked
+# against it must not be reused past that; default layouts are re-signed
+# before they expire, so their results do not expire.
+def _layout_inputs(binary_hashes, link_urls, id_key_urls, intoto, downloader):
+    expires_at = None
+    if intoto.get("layout_path"):
+        mode = "custom-layout"
+        with open(intoto["layout_path"], "rb") as f:
+            layout_raw = f.read()
+        layout = [results.digest(layout_raw)]
+        try:
+            expires_at = intoto_tools.parse_expires(json.loads(layout_raw)["signed"]["expires"]).timestamp()
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"layout at {intoto['layout_path']} has no valid expiry date") from e
+        if intoto.get("layout_key"):
+            with open(intoto["layout_key"], "rb") as f:
+                layout.append(results.digest(f.read()))
+    else:
+        mode = "default-layout"
+        layout = [intoto.get("layout_key_type") or "rsa"]
+    return mode, [
+        sorted(binary_hashes.items()),
+        sorted((link["filename"], downloader.spool(link["url"])[1]) for link in link_urls.values()),
+        sorted((key["filename"], downloader.spool(key["url"])[1]) for key in id_key_urls.values()),
+        layout,
+    ], expires_at
@@ -0,0 +1,119 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from . import allowlists, artifacts, github, intoto_tools, trace
+
+# Number of repositories verified concurrently when none is specified.
+DEFAULT_JOBS = 4
+
+# Reads a batch manifest from manifest_path. A manifest is a JSON document of the form:
+#
+# {
+#   "repositories": [
+#     {
+#       "owner": "mbestavros",
+#       "repository": "supply-chain-pipeline-demo",
+#       "tag": null,
+#       "destination_app_path": "/root/hello-go",
+#       "local_app_path": null,
+#       "intoto": "default-layout",
+#       "intoto_key": null,
+#       "intoto_key_password": null,
+#       "layout_key_type": "rsa",
+#       "sigstore": false
+#     }
+#   ]
+# }
+#
+# Only "owner" and "repository" are required for each entry.
+def load_manifest(manifest_path):
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+
+    entries = manifest["repositories"]
+    for entry in entries:
+        if not entry.get("owner") or not entry.get("repository"):
+            raise ValueError(f"Manifest entry is missing an owner or repository: {entry}")
+    return entries
+
+# Verifies every manifest entry on a pool of jobs threads sharing downloader, and
+# merges the verified hashes of each successful entry with a destination_app_path
+# into policy in each of hash_algorithms, unless that path matches excludelist.
+# Releases are resolved up front with batched GraphQL requests of
+# graphql_batch_size repositories. Default in-toto layouts are cached in
+# layout_cache_dir (see verify_entry). Returns the amended policy and a
+# per-repository report; a failing repository is recorded in the report instead
+# of stopping the batch.
+def run_batch(entries, token, downloader, policy, jobs=DEFAULT_JOBS, graphql_batch_size=github.DEFAULT_BATCH_SIZE, excludelist=None, hash_algorithms=("sha256",), layout_cache_dir=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR):
+    repos = [(entry["owner"], entry["repository"], entry.get("tag")) for entry in entries]
+    unresolved = {}
+    with trace.span("github.fetch_releases_batch", repositories=len(repos)):
+        releases = github.fetch_releases_batch(repos, token, graphql_batch_size, unresolved)
+
+    # Releases that could not be resolved are reported as failures rather than
+    # looked up again by verify_entry.
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = []
+        for entry, repo in zip(entries, repos):
+            release = releases.get(github.release_key(*repo))
+            futures.append(executor.submit(verify_entry, entry, token, downloader, github.organize_assets(release["assets"]), release["tag"], layout_cache_dir) if release else None)
+
+    report = []
+    for entry, repo, future in zip(entries, repos, futures):
+        name = f"{entry['owner']}/{entry['repository']}"
+        if future is None:
+            report.append({"repository": name, "success": False, "error": unresolved[github.release_key(*repo)]})
+            continue
+        try:
+            verified_digests = future.result()
+        except Exception as e:
+            report.append({"repository": name, "success": False, "error": str(e)})
+            continue
+
+        verified_hashes = [digests["sha256"] for digests in verified_digests]
+        if not verified_hashes:
+            report.append({"repository": name, "success": False, "error": "no artifact hashes were verified"})
+            continue
+
+        destination_app_path = entry.get("destination_app_path")
+        if destination_app_path and excludelist and excludelist.matches(destination_app_path):
+            print(f"{name}: Destination path {destination_app_path} matches the excludelist, not adding it to the policy")
+        elif destination_app_path:
+            policy = allowlists.append_digests_to_allowlist(policy, destination_app_path, verified_digests[0], hash_algorithms)
+        report.append({"repository": name, "success": True, "verified_hashes": verified_hashes, "destination_app_path": destination_app_path})
+
+    return policy, report
+
+def print_report(report):
+    for result in report:
+        if result["success"]:
+            print(f"PASS {result['repository']}: {', '.join(result['verified_hashes'])}")
+        else:
+            print(f"FAIL {result['repository']}: {result['error']}")
+    failures = len([r for r in report if not r["success"]])
+    print(f"{len(report) - failures} of {len(report)} repositories verified")
+
+# Verifies the release of a single manifest entry and returns the verified
+# digests of its artifacts. links and tag may provide an already-resolved
+# release, otherwise the entry's own tag (or latest release) is used. Default
+# in-toto layouts are cached in layout_cache_dir, or not at all if it is None.
+def verify_entry(entry, token, downloader, links=None, tag=None, layout_cache_dir=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR):
+    intoto = None
+    if entry.get("intoto"):
+        intoto = {
+            "layout_path": entry["intoto"],
+            "layout_key": entry.get("intoto_key"),
+            "layout_key_password": entry.get("intoto_key_password"),
+            "layout_key_type": entry.get("layout_key_type"),
+            "layout_cache_dir": layout_cache_dir
+        }
+    return artifacts.fetch_verified_digests(
+        entry["owner"],
+        entry["repository"],
+        token,
+        entry.get("local_app_path"),
+        entry.get("sigstore", False),
+        intoto,
+        downloader,
+        tag or entry.get("tag"),
+        links
+    )
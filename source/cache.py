@@ -0,0 +1,198 @@
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+# Default location and size cap of the on-disk release asset cache.
+DEFAULT_CACHE_DIR = os.path.join(os.getenv("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "keylime-supply-chain-bridge")
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Seconds an abandoned partial download is kept around to be resumed.
+PARTIAL_MAX_AGE = 7 * 24 * 60 * 60
+# Seconds a blob no index entry refers to is kept before it is removed, in case
+# the process that stored it has yet to record it.
+ORPHAN_GRACE_PERIOD = 60 * 60
+
+# Persistent cache of downloaded release assets. Contents are stored once per
+# SHA-256 digest under blobs/, and an index maps each asset URL to its digest
+# and ETag so later runs can revalidate with conditional requests. Blobs are
+# evicted least-recently-used first once the cache grows past max_bytes; blobs
+# handed out during this process are never evicted from under their readers.
+# Several processes can share a cache: the index is re-read and merged under a
+# file lock whenever it is written, so no process drops another's entries.
+class AssetCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._blob_dir = os.path.join(directory, "blobs")
+        self._partial_dir = os.path.join(directory, "partial")
+        self._index_path = os.path.join(directory, "index.json")
+        self._index_lock_path = os.path.join(directory, "index.lock")
+        self._lock = threading.Lock()
+        self._pinned = set()
+        os.makedirs(self._blob_dir, exist_ok=True)
+        os.makedirs(self._partial_dir, exist_ok=True)
+
+        self._entries = {}
+        with self._index_lock():
+            # Drop index entries whose blob disappeared, and blobs no entry has
+            # referred to for a while.
+            self._merge_index()
+            referenced = {e["sha256"] for e in self._entries.values()}
+            for name in os.listdir(self._blob_dir):
+                path = os.path.join(self._blob_dir, name)
+                try:
+                    if name not in referenced and time.time() - os.path.getmtime(path) > ORPHAN_GRACE_PERIOD:
+                        os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._write_index()
+        # Partial downloads nobody resumed for a while are dropped.
+        for name in os.listdir(self._partial_dir):
+            path = os.path.join(self._partial_dir, name)
+            try:
+                if time.time() - os.path.getmtime(path) > PARTIAL_MAX_AGE:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def blob_path(self, digest):
+        return os.path.join(self._blob_dir, digest)
+
+    # Returns the cached entry for url ({"sha256", "etag", "size", "last_used",
+    # "digests"}), or None. Its blob is pinned for this process, so that it is
+    # not evicted while the entry is revalidated.
+    def lookup(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry:
+                return None
+            self._pinned.add(entry["sha256"])
+            return dict(entry)
+
+    # Marks the cached entry for url as used and returns the path of its blob,
+    # whose SHA-256 digest must be digest. Returns None if the entry changed or
+    # its blob is gone, e.g. because another process sharing the cache evicted it.
+    def touch(self, url, digest):
+        with self._lock:
+            entry = self._entries.get(url)
+            if not entry or entry["sha256"] != digest or not os.path.exists(self.blob_path(digest)):
+                return None
+            entry["last_used"] = time.time()
+            self._pinned.add(digest)
+            return self.blob_path(digest)
+
+    # Returns a fresh path inside the cache directory to download into, so that
+    # completed downloads can be moved into place atomically.
+    def partial_path(self):
+        fd, path = tempfile.mkstemp(dir=self._partial_dir, suffix=".part")
+        os.close(fd)
+        return path
+
+    # Context manager yielding the path url is downloaded into. The path is the
+    # same across runs, so an interrupted download can be resumed later, and is
+    # locked for as long as the context lasts. If another process holds the
+    # lock, a fresh path is yielded instead and removed afterwards.
+    @contextlib.contextmanager
+    def partial_lock(self, url):
+        path = os.path.join(self._partial_dir, hashlib.sha256(url.encode()).hexdigest() + ".part")
+        with open(path + ".lock", "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                path = self.partial_path()
+                try:
+                    yield path
+                finally:
+                    for leftover in (path, path + ".json"):
+                        if os.path.exists(leftover):
+                            os.remove(leftover)
+                return
+            # Keeps the lock file from being cleaned up as abandoned while in use.
+            os.utime(path + ".lock")
+            yield path
+
+    # Moves the completed download at partial_path into the cache as the content
+    # of url, then evicts old blobs if needed. digests may record other digests
+    # of the content ({algorithm: hex digest}). Returns the blob path.
+    def store(self, url, partial_path, digest, etag=None, digests=None):
+        blob_path = self.blob_path(digest)
+        with self._lock, self._index_lock():
+            os.replace(partial_path, blob_path)
+            self._merge_index()
+            self._entries[url] = {
+                "sha256": digest,
+                "etag": etag,
+                "size": os.path.getsize(blob_path),
+                "last_used": time.time(),
+                "digests": dict(digests or {}),
+            }
+            self._pinned.add(digest)
+            self._evict()
+            self._write_index()
+        return blob_path
+
+    # Records more digests ({algorithm: hex digest}) of the cached content of url.
+    def add_digests(self, url, digests):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                entry.setdefault("digests", {}).update(digests)
+
+    def save(self):
+        with self._lock, self._index_lock():
+            self._merge_index()
+            self._write_index()
+
+    # Context manager holding the lock on the index shared by every process using the cache.
+    @contextlib.contextmanager
+    def _index_lock(self):
+        with open(self._index_lock_path, "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    # Merges the index on disk into this process's entries, keeping the most
+    # recently used entry of each URL and only entries whose blob still exists.
+    # Must be called with the index lock held.
+    def _merge_index(self):
+        on_disk = {}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r") as f:
+                    on_disk = json.load(f)
+            except ValueError:
+                print(f"WARNING: Ignoring unreadable cache index at {self._index_path}")
+        for url, entry in on_disk.items():
+            mine = self._entries.get(url)
+            if mine is None or (mine["sha256"] != entry["sha256"] and mine["last_used"] < entry["last_used"]):
+                self._entries[url] = entry
+            elif mine["sha256"] == entry["sha256"]:
+                mine["last_used"] = max(mine["last_used"], entry["last_used"])
+                mine["digests"] = dict(entry.get("digests") or {}, **mine.get("digests", {}))
+        self._entries = {url: e for url, e in self._entries.items() if os.path.exists(self.blob_path(e["sha256"]))}
+
+    # Must be called with the index lock held.
+    def _write_index(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._entries, f)
+        os.replace(tmp_path, self._index_path)
+
+    def _evict(self):
+        blobs = {}
+        for entry in self._entries.values():
+            blob = blobs.setdefault(entry["sha256"], {"size": entry["size"], "last_used": 0})
+            blob["last_used"] = max(blob["last_used"], entry["last_used"])
+
+        total = sum(blob["size"] for blob in blobs.values())
+        for digest, blob in sorted(blobs.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if digest in self._pinned:
+                continue
+            os.remove(self.blob_path(digest))
+            self._entries = {url: e for url, e in self._entries.items() if e["sha256"] != digest}
+            total -= blob["size"]
@@ -1,11 +1,16 @@
-RELEASES_QUERY = '''
-query($owner:String!, $repo:String!, $releasesCursor:String) {
+LATEST_RELEASE_QUERY = '''
+query($owner:String!, $repo:String!, $releaseAssetsCursor:String) {
   repository(owner: $owner, name: $repo) {
-    releases(first:100, after:$releasesCursor) {
-      pageInfo { endCursor hasNextPage }
-      nodes {
-        isLatest
-        tagName
+    latestRelease {
+      tagName
+      releaseAssets(first: 100, after:$releaseAssetsCursor) {
+        pageInfo { endCursor hasNextPage }
+        nodes {
+          name
+          downloadUrl
+          size
+          digest
+        }
       }
     }
   }
@@ -16,14 +21,32 @@ ARTIFACTS_QUERY = '''
 query($owner:String!, $repo:String!, $tagName:String!, $releaseAssetsCursor:String) {
   repository(owner: $owner, name: $repo) {
     release(tagName: $tagName) {
+      tagName
       releaseAssets(first: 100, after:$releaseAssetsCursor) {
         pageInfo { endCursor hasNextPage }
         nodes {
           name
           downloadUrl
+          size
+          digest
         }
       }
     }
   }
 }
 '''
+
+# Release fields shared by the aliased multi-repository query built in
+# github.fetch_releases_batch.
+BATCH_RELEASE_FIELDS = '''
+tagName
+releaseAssets(first: 100) {
+  pageInfo { endCursor hasNextPage }
+  nodes {
+    name
+    downloadUrl
+    size
+    digest
+  }
+}
+'''
@@ -0,0 +1,421 @@
+import hashlib
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import trace
+
+# Size of the chunks read from the network or from disk while spooling and hashing.
+CHUNK_SIZE = 1024 * 1024
+
+# Number of concurrent downloads used when none is specified.
+DEFAULT_WORKERS = 8
+
+# Number of times an interrupted download is retried, and the bounds in seconds
+# of the exponential backoff between attempts.
+DEFAULT_RETRIES = 5
+BACKOFF_INITIAL = 0.5
+BACKOFF_MAX = 30
+# Seconds to wait for a connection, and for the next bytes of a response,
+# before an attempt is considered dropped.
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+# Assets at least this large are split into ranged segments downloaded in
+# parallel, if the Downloader is configured with more than one segment.
+SEGMENT_MIN_SIZE = 64 * 1024 * 1024
+# Progress of each segment is recorded at least every this many bytes.
+STATE_SAVE_INTERVAL = 16 * 1024 * 1024
+
+# Raised when a download cannot be completed or does not have its expected size.
+class DownloadError(Exception):
+    pass
+
+# Raised when an attempt ended before the whole body was received.
+class _Incomplete(Exception):
+    pass
+
+# Digest algorithms that can be computed while spooling and hashing. SHA-256 is
+# always computed, as it is what signatures, Github and the cache rely on.
+SUPPORTED_ALGORITHMS = ("sha1", "sha256", "sha384", "sha512")
+DEFAULT_ALGORITHMS = ("sha256",)
+
+# Returns algorithms with SHA-256 first and duplicates removed, rejecting unsupported ones.
+def normalize_algorithms(algorithms):
+    algorithms = tuple(dict.fromkeys(("sha256",) + tuple(algorithms)))
+    unsupported = [a for a in algorithms if a not in SUPPORTED_ALGORITHMS]
+    if unsupported:
+        raise ValueError(f"Unsupported digest algorithms: {', '.join(unsupported)} (supported: {', '.join(SUPPORTED_ALGORITHMS)})")
+    return algorithms
+
+# Computes several digests of the same content in a single pass over its chunks.
+class MultiHasher:
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS):
+        self._hashers = {algorithm: hashlib.new(algorithm) for algorithm in algorithms}
+
+    def update(self, chunk):
+        for hasher in self._hashers.values():
+            hasher.update(chunk)
+
+    # Returns {algorithm: hex digest}.
+    def hexdigests(self):
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self._hashers.items()}
+
+# Hashes the file present at path in fixed-size chunks and returns its SHA-256 hex digest.
+def hash_file(path):
+    return hash_file_digests(path)["sha256"]
+
+# Hashes the file present at path in fixed-size chunks with every algorithm at
+# once, reading it a single time. Returns {algorithm: hex digest}.
+def hash_file_digests(path, algorithms=DEFAULT_ALGORITHMS):
+    hasher = MultiHasher(algorithms)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigests()
+
+# Schedules release asset downloads on a bounded thread pool sharing one pooled
+# keep-alive session. Each URL is downloaded at most once per Downloader; later
+# requests for the same URL wait on (or reuse) the first download. If a cache is
+# provided, downloads land in it and are revalidated with If-None-Match.
+# Downloads are hashed with every algorithm in algorithms as they are written.
+#
+# Downloads are written to a partial file first. An interrupted download is
+# retried up to retries times with bounded exponential backoff, resuming with a
+# Range request (guarded by If-Range) from the bytes already received. With a
+# cache, partial files survive the run, so the next run resumes them too.
+# Assets of at least SEGMENT_MIN_SIZE bytes are split into segments ranged
+# requests downloaded in parallel; retries only request the missing part of
+# unfinished segments.
+class Downloader:
+    def __init__(self, workers=DEFAULT_WORKERS, cache=None, algorithms=DEFAULT_ALGORITHMS, segments=1, retries=DEFAULT_RETRIES):
+        self.cache = cache
+        self.algorithms = normalize_algorithms(algorithms)
+        self.segments = max(1, segments)
+        self.retries = retries
+        # requests is only loaded by runs that download something.
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.session = requests.Session()
+        # Bodies are requested as-is, so that byte ranges and sizes refer to the asset itself.
+        self.session.headers["Accept-Encoding"] = "identity"
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers * self.segments)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._spool_dir = tempfile.TemporaryDirectory()
+        self._futures = {}
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+        self._spool_dir.cleanup()
+        if self.cache:
+            self.cache.save()
+
+    # Queues downloads for all provided URLs without waiting for them. sizes may
+    # map URLs to their expected size in bytes (e.g. as reported by Github);
+    # downloads of another size fail.
+    def prefetch(self, urls, sizes=None):
+        with self._lock:
+            self._sizes.update({url: size for url, size in (sizes or {}).items() if size is not None})
+        for url in urls:
+            self._submit(url)
+
+    # Returns the (path, SHA-256 hex digest) of the spooled download of url.
+    def spool(self, url):
+        path, digests = self._submit(url).result()
+        return path, digests["sha256"]
+
+    # Returns the (path, {algorithm: hex digest}) of the spooled download of url.
+    def spool_digests(self, url):
+        return self._submit(url).result()
+
+    # Hashes the local file at path on the download pool, so that it is hashed
+    # alongside downloads in flight. Returns a future of {algorithm: hex digest}.
+    def hash_local(self, path):
+        return self._executor.submit(hash_file_digests, path, self.algorithms)
+
+    # Returns the full contents of url. Only meant for small assets such as
+    # signatures, certificates, linkfiles and keys.
+    def fetch(self, url):
+        path, _ = self.spool(url)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _submit(self, url):
+        with self._lock:
+            future = self._futures.get(url)
+            if future is None:
+                future = self._executor.submit(self._download, url)
+                self._futures[url] = future
+        return future
+
+    def _download(self, url):
+        with trace.span("download", url=url) as span:
+            return self._fetch(url, span)
+
+    def _fetch(self, url, span):
+        expected_size = self._sizes.get(url)
+        if self.cache is None:
+            dest_path = os.path.join(self._spool_dir.name, hashlib.sha256(url.encode()).hexdigest())
+            digests, _ = self._transfer(url, dest_path, span, {}, expected_size)
+            return dest_path, digests
+
+        entry = self.cache.lookup(url)
+        headers = {"If-None-Match": entry["etag"]} if entry and entry["etag"] else {}
+        # Another process downloading the same URL into the cache keeps its
+        # partial file; this one then downloads into a private one.
+        with self.cache.partial_lock(url) as dest_path:
+            result = self._transfer(url, dest_path, span, headers, expected_size)
+            blob_path = self.cache.touch(url, entry["sha256"]) if result is None else None
+            if blob_path:
+                span.add("cache_hits")
+                digests = dict(entry.get("digests") or {}, sha256=entry["sha256"])
+                # Blobs cached before other algorithms were requested are hashed once more.
+                if any(a not in digests for a in self.algorithms):
+                    digests = hash_file_digests(blob_path, self.algorithms)
+                    self.cache.add_digests(url, digests)
+                return blob_path, {a: digests[a] for a in self.algorithms}
+            if result is None:
+                # The cached copy went away while it was being revalidated.
+                span.add("cache_lost")
+                result = self._transfer(url, dest_path, span, {}, expected_size)
+            span.add("cache_misses")
+            digests, etag = result
+            return self.cache.store(url, dest_path, digests["sha256"], etag, digests), digests
+
+    # Downloads url into dest_path, resuming what earlier attempts left there,
+    # and retrying interrupted attempts. headers are sent with the first
+    # request; if they make it conditional and the server answers 304, any
+    # partial download is discarded and None is returned. Otherwise returns the
+    # ({algorithm: hex digest}, ETag) of the completed download.
+    def _transfer(self, url, dest_path, span, headers, expected_size=None):
+        state = _load_state(dest_path, url)
+        attempt = 0
+        while True:
+            try:
+                if state and state.get("segments"):
+                    digests = self._receive_segments(url, dest_path, state, span)
+                else:
+                    received = self._receive(url, dest_path, state, span, headers)
+                    if received is None:
+                        _discard(dest_path)
+                        return None
+                    state, digests = received
+                    # Large assets are continued as parallel segments.
+                    if digests is None:
+                        continue
+            except Exception as e:
+                if not _retryable(e) or attempt >= self.retries:
+                    if not isinstance(e, _Incomplete):
+                        raise
+                    raise DownloadError(f"Download of {url} failed after {attempt + 1} attempts: {e}") from e
+                attempt += 1
+                delay = min(BACKOFF_MAX, BACKOFF_INITIAL * 2 ** (attempt - 1)) * random.uniform(0.5, 1)
+                print(f"WARNING: Download of {url} interrupted ({e}), retrying in {delay:.1f}s ({attempt}/{self.retries})")
+                span.add("retries")
+                time.sleep(delay)
+                state = _load_state(dest_path, url)
+                continue
+
+            size = os.path.getsize(dest_path)
+            if expected_size is not None and size != expected_size:
+                _discard(dest_path)
+                raise DownloadError(f"Download of {url} is {size} bytes, expected {expected_size}")
+            _remove_state(dest_path)
+            return digests, state.get("etag")
+
+    # Makes one attempt at downloading url into dest_path as a single stream,
+    # from the end of the partial download described by state if there is one.
+    # Returns None if the server answered 304, or the new state and the digests
+    # of the complete download. Digests are None if the asset is large enough to
+    # be continued in segments, which state then describes.
+    def _receive(self, url, dest_path, state, span, headers):
+        offset = os.path.getsize(dest_path) if state and os.path.exists(dest_path) else 0
+        request_headers = dict(headers)
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            if state.get("validator"):
+                request_headers["If-Range"] = state["validator"]
+
+        span.add("http_requests")
+        with self.session.get(url, stream=True, headers=request_headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            if response.status_code == 304 and "If-None-Match" in headers:
+                return None
+            if response.status_code == 416:
+                _discard(dest_path)
+                raise _Incomplete("the partial download no longer matches the asset, starting over")
+            response.raise_for_status()
+            resumed = bool(offset) and response.status_code == 206
+            if not resumed:
+                offset = 0
+            total = _total_size(response, offset)
+            state = {"url": url, "etag": response.headers.get("ETag"), "validator": _validator(response), "size": total}
+
+            if (not resumed and self.segments > 1 and total and total >= SEGMENT_MIN_SIZE
+                    and response.headers.get("Accept-Ranges") == "bytes" and state["validator"]):
+                state["segments"] = _plan_segments(total, self.segments)
+                with open(dest_path, "wb") as f:
+                    f.truncate(total)
+                _save_state(dest_path, state)
+                return state, None
+            _save_state(dest_path, state)
+
+            hasher = MultiHasher(self.algorithms)
+            if resumed:
+                print(f"Resuming download of {url} from byte {offset}")
+                span.add("resumed_bytes", offset)
+                with open(dest_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(min(CHUNK_SIZE, offset - f.tell())), b""):
+                        hasher.update(chunk)
+            with open(dest_path, "ab" if resumed else "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    span.add("bytes", len(chunk))
+
+        size = os.path.getsize(dest_path)
+        if total is not None and size != total:
+            raise _Incomplete(f"received {size} of {total} bytes")
+        return state, hasher.hexdigests()
+
+    # Makes one attempt at downloading every unfinished segment of state in
+    # parallel, then hashes the complete download. Finished segments are never
+    # requested again.
+    def _receive_segments(self, url, dest_path, state, span):
+        lock = threading.Lock()
+        def save():
+            with lock:
+                _save_state(dest_path, state)
+
+        pending = [segment for segment in state["segments"] if segment[0] + segment[2] <= segment[1]]
+        if pending:
+            print(f"Downloading {len(pending)} of {len(state['segments'])} segments of {url} ({state['size']} bytes) in parallel")
+            with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                futures = [executor.submit(self._receive_segment, url, dest_path, state, segment, save) for segment in pending]
+                errors = []
+                for future in futures:
+                    try:
+                        span.add("bytes", future.result())
+                    except Exception as e:
+                        errors.append(e)
+                    span.add("http_requests")
+            save()
+            if errors:
+                # The asset changed since the download started: start over.
+                if any(isinstance(e, _AssetChanged) for e in errors):
+                    _discard(dest_path)
+                raise errors[0]
+
+        with trace.span("download.hash", url=url):
+            return hash_file_digests(dest_path, self.algorithms)
+
+    # Downloads the missing part of segment ([start, end, bytes received]) into
+    # dest_path, recording progress in segment as it goes. Returns the number
+    # of bytes received.
+    def _receive_segment(self, url, dest_path, state, segment, save):
+        start, end, received = segment
+        headers = {"Range": f"bytes={start + received}-{end}", "If-Range": state["validator"]}
+        with self.session.get(url, stream=True, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise _AssetChanged(f"{url} changed while it was downloading, starting over")
+            with open(dest_path, "r+b") as f:
+                f.seek(start + received)
+                unsaved = 0
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    chunk = chunk[:end + 1 - (start + segment[2])]
+                    f.write(chunk)
+                    segment[2] += len(chunk)
+                    unsaved += len(chunk)
+                    if unsaved >= STATE_SAVE_INTERVAL:
+                        f.flush()
+                        save()
+                        unsaved = 0
+                    if start + segment[2] > end:
+                        break
+        if start + segment[2] <= end:
+            raise _Incomplete(f"segment {start}-{end} ended after {segment[2]} bytes")
+        return segment[2] - received
+
+# Raised when a segment's If-Range validator no longer matches the asset.
+class _AssetChanged(_Incomplete):
+    pass
+
+# Returns whether a failed attempt is worth retrying: dropped connections,
+# timeouts, truncated bodies and server-side errors are.
+def _retryable(e):
+    import requests
+    if isinstance(e, (_Incomplete, requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    if isinstance(e, requests.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500 or e.response.status_code == 429
+    return False
+
+# Returns the full size of the asset a response is part of, or None if unknown.
+def _total_size(response, offset):
+    content_range = re.fullmatch(r"bytes \d+-\d+/(\d+)", response.headers.get("Content-Range", ""))
+    if content_range:
+        return int(content_range.group(1))
+    length = response.headers.get("Content-Length")
+    return offset + int(length) if length is not None else None
+
+# Returns the validator an If-Range request for the asset of response can use:
+# its ETag if strong, otherwise its Last-Modified date.
+def _validator(response):
+    etag = response.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get("Last-Modified")
+
+# Splits total bytes into count segments of [start, end, bytes received].
+def _plan_segments(total, count):
+    size = -(-total // count)
+    return [[start, min(total, start + size) - 1, 0] for start in range(0, total, size)]
+
+def _state_path(dest_path):
+    return dest_path + ".json"
+
+# Returns the recorded state of the partial download of url at dest_path, or None.
+def _load_state(dest_path, url):
+    if not os.path.exists(dest_path):
+        return None
+    try:
+        with open(_state_path(dest_path), "r") as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return state if state.get("url") == url else None
+
+def _save_state(dest_path, state):
+    directory = os.path.dirname(os.path.abspath(dest_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, _state_path(dest_path))
+
+def _remove_state(dest_path):
+    try:
+        os.remove(_state_path(dest_path))
+    except FileNotFoundError:
+        pass
+
+# Removes the partial download at dest_path and its state.
+def _discard(dest_path):
+    for path in (dest_path, _state_path(dest_path)):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,38 +1,128 @@
+import json
 import os
 import sys
+import time
 
+from . import trace
 from .constants import github_constants
-from githubgql import githubgql
 
-def fetch_links_from_github(owner, repo, token):
-    # Pagination cursors needed for API requests
-    releases_cursors = {"releasesCursor": ["repository", "releases"]}
-    artifacts_cursors = {"releaseAssetsCursor": ["repository", "release", "releaseAssets"]}
+# Response codes a batched GraphQL request is retried on, and how many times,
+# as githubgql does for single queries.
+RETRY_CODES = (403, 429, 500, 502, 503, 504)
+MAX_RETRIES = 8
 
-    # Fetch all releases from provided repo and find latest
-    try:
-        releases_result = githubgql.graphql(github_constants.RELEASES_QUERY, token=token, cursors=releases_cursors, owner=owner, repo=repo)
-    except githubgql.TokenError as e:
-        print(e.error)
-        sys.exit(0)
+# Number of repositories resolved per aliased GraphQL request. Every repository
+# can return up to 100 assets, so the upper bound keeps a request at roughly
+# 10,000 nodes, far below Github's per-query node and cost limits.
+DEFAULT_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 100
 
-    latest_tag_name = None
-    for release in releases_result["repository"]["releases"]["nodes"]:
-        if release["isLatest"] == True:
-            latest_tag_name = release["tagName"]
+# Fetches the latest release of the provided repo, or the release tagged tag if
+# provided, along with its assets in a single query. Asset lists are only
+# paginated when a release has more than 100 assets.
+def fetch_release(owner, repo, token, tag=None):
+    from githubgql import githubgql
+    if tag:
+        release_field = "release"
+        query = github_constants.ARTIFACTS_QUERY
+        variables = {"tagName": tag}
+    else:
+        release_field = "latestRelease"
+        query = github_constants.LATEST_RELEASE_QUERY
+        variables = {}
 
-    # Fetch all asset URLs from the latest release
     try:
-        artifacts_result = githubgql.graphql(github_constants.ARTIFACTS_QUERY, token=token, cursors=artifacts_cursors, owner=owner, repo=repo, tagName=latest_tag_name)
+        try:
+            result = _graphql(query, token=token, owner=owner, repo=repo, **variables)
+        except githubgql.GraphQLError as e:
+            if _not_found(e.errors):
+                raise LookupError(f"{owner}/{repo} was not found") from e
+            raise
+        release = result["repository"][release_field]
+        if release is None:
+            raise LookupError(f"{owner}/{repo} has no {f'release tagged {tag}' if tag else 'latest release'}")
+
+        # Only releases with more than 100 assets need further pages.
+        page_info = release["releaseAssets"].pop("pageInfo")
+        if page_info["hasNextPage"]:
+            artifacts_cursors = {"releaseAssetsCursor": ["repository", release_field, "releaseAssets"]}
+            rest = _graphql(query, token=token, cursors=artifacts_cursors, owner=owner, repo=repo, releaseAssetsCursor=page_info["endCursor"], **variables)
+            release["releaseAssets"]["nodes"].extend(rest["repository"][release_field]["releaseAssets"]["nodes"])
     except githubgql.TokenError as e:
         print(e.error)
         sys.exit(0)
 
-    # Organize URLs into understandable dictionaries
+    return {"tag": release["tagName"], "assets": release["releaseAssets"]["nodes"]}
+
+def fetch_links_from_github(owner, repo, token, tag=None):
+    return organize_assets(fetch_release(owner, repo, token, tag)["assets"])
+
+# Key identifying a repository (and optionally a release tag) in batch results.
+def release_key(owner, repo, tag=None):
+    return f"{owner}/{repo}@{tag}" if tag else f"{owner}/{repo}"
+
+# Fetches the latest release (or the tagged release) and assets of every
+# (owner, repo, tag) in repos, using one aliased GraphQL request per batch_size
+# repositories. Returns a dictionary keyed by release_key. Releases with more
+# than 100 assets are completed with fetch_release. Errors only void the
+# repositories whose aliases they name: repositories that do not exist, or have
+# no such release, are left out of the result, and the others are resolved one
+# by one with fetch_release. If the whole request fails, every repository of its
+# batch is. The reason each left-out repository could not be resolved is
+# recorded in errors, if given.
+def fetch_releases_batch(repos, token, batch_size=DEFAULT_BATCH_SIZE, errors=None):
+    from githubgql import githubgql
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    releases = {}
+    for start in range(0, len(repos), batch_size):
+        chunk = repos[start:start + batch_size]
+        query, variables = _build_batch_query(chunk)
+        try:
+            result, alias_errors = _graphql_partial(query, token=token, **variables)
+        except githubgql.TokenError as e:
+            print(e.error)
+            sys.exit(0)
+        except (githubgql.GraphQLError, githubgql.HTTPError):
+            result, alias_errors = None, {}
+
+        for i, (owner, repo, tag) in enumerate(chunk):
+            key = release_key(owner, repo, tag)
+            failures = alias_errors.get(f"r{i}")
+            if failures and _not_found(failures):
+                _record_failure(key, LookupError(f"{owner}/{repo} was not found"), errors)
+                continue
+            release = None
+            if result is not None and not failures:
+                repository = result.get(f"r{i}")
+                release = repository and repository["release" if tag else "latestRelease"]
+                if repository and release is None:
+                    _record_failure(key, LookupError(f"{owner}/{repo} has no {f'release tagged {tag}' if tag else 'latest release'}"), errors)
+                    continue
+            if release is None or release["releaseAssets"]["pageInfo"]["hasNextPage"]:
+                try:
+                    releases[key] = fetch_release(owner, repo, token, tag)
+                except Exception as e:
+                    _record_failure(key, e, errors)
+                continue
+            releases[key] = {"tag": release["tagName"], "assets": release["releaseAssets"]["nodes"]}
+    return releases
+
+# Batched counterpart of fetch_links_from_github, keyed by release_key.
+def fetch_links_batch(repos, token, batch_size=DEFAULT_BATCH_SIZE, errors=None):
+    releases = fetch_releases_batch(repos, token, batch_size, errors)
+    return {key: organize_assets(release["assets"]) for key, release in releases.items()}
+
+def _record_failure(key, error, errors):
+    print(f"{key}: Could not resolve release: {error}")
+    if errors is not None:
+        errors[key] = str(error)
+
+# Organize release asset URLs into understandable dictionaries
+def organize_assets(assets):
     artifacts_formatted = {}
     link_urls = {}
     id_key_urls = {}
-    for asset in artifacts_result["repository"]["release"]["releaseAssets"]["nodes"]:
+    for asset in assets:
         root, extension = os.path.splitext(asset["name"])
         url = asset["downloadUrl"]
         if extension == ".link":
@@ -50,5 +140,79 @@ def fetch_links_from_github(owner, repo, token):
                     artifacts_formatted[root]["crt"] = url
                 case _:
                     artifacts_formatted[root]["artifact"] = url
+                    artifacts_formatted[root]["size"] = asset.get("size")
+                    artifacts_formatted[root]["sha256"] = _asset_sha256(asset)
 
     return artifacts_formatted, link_urls, id_key_urls
+
+# Runs a GraphQL query through githubgql within a trace span. githubgql (and
+# requests with it) is only loaded once a query is made.
+def _graphql(query, **kwargs):
+    from githubgql import githubgql
+    with trace.span("github.graphql", owner=kwargs.get("owner"), repo=kwargs.get("repo")) as span:
+        span.add("http_requests")
+        return githubgql.graphql(query, **kwargs)
+
+# Runs a GraphQL query like _graphql, but keeps the data of a partially failed
+# query: githubgql raises on any error and drops it. Returns the data and the
+# errors keyed by the top-level field (alias) they concern. Raises
+# githubgql.GraphQLError only if the query returned no data at all.
+def _graphql_partial(query, token=None, **kwargs):
+    from githubgql import githubgql
+    import requests
+    if not token:
+        raise githubgql.TokenError(error="\nNo Github access token provided.\n    ")
+
+    url = os.environ.get("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+    params = {"query": query.strip(), "variables": json.dumps(kwargs)}
+    headers = {"Authorization": f"token {token}", "Accept": ""}
+    with trace.span("github.graphql") as span:
+        span.add("http_requests")
+        reply = requests.post(url, json=params, headers=headers)
+        for attempt in range(MAX_RETRIES):
+            if reply.status_code not in RETRY_CODES:
+                break
+            time.sleep(2 ** (attempt - 1))
+            span.add("http_requests")
+            reply = requests.post(url, json=params, headers=headers)
+    if reply.status_code != 200:
+        raise githubgql.HTTPError(reply)
+
+    body = reply.json()
+    if not body.get("data"):
+        raise githubgql.GraphQLError(body.get("errors", []))
+    alias_errors = {}
+    for error in body.get("errors", []):
+        if not error.get("path"):
+            raise githubgql.GraphQLError(body["errors"])
+        alias_errors.setdefault(error["path"][0], []).append(error)
+    return body["data"], alias_errors
+
+# Returns whether every one of the GraphQL errors reports a missing resource.
+def _not_found(errors):
+    return bool(errors) and all(error.get("type") == "NOT_FOUND" for error in errors)
+
+def _build_batch_query(repos):
+    params = []
+    fields = []
+    variables = {}
+    for i, (owner, repo, tag) in enumerate(repos):
+        params += [f"$owner{i}:String!", f"$repo{i}:String!"]
+        variables[f"owner{i}"] = owner
+        variables[f"repo{i}"] = repo
+        if tag:
+            params.append(f"$tag{i}:String!")
+            variables[f"tag{i}"] = tag
+            release = f"release(tagName: $tag{i})"
+        else:
+            release = "latestRelease"
+        fields.append(f"r{i}: repository(owner: $owner{i}, name: $repo{i}) {{ {release} {{ {github_constants.BATCH_RELEASE_FIELDS} }} }}")
+    query = f"query({', '.join(params)}) {{\n" + "\n".join(fields) + "\n}"
+    return query, variables
+
+# Returns the SHA-256 hex digest Github reports for an asset, if any.
+def _asset_sha256(asset):
+    digest = asset.get("digest")
+    if digest and digest.startswith("sha256:"):
+        return digest[len("sha256:"):]
+    return None
@@ -0,0 +1,97 @@
+import hashlib
+import hmac
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from . import server
+
+# HTTP API of the verification service:
+#
+#   POST /verify    a manifest entry, e.g. {"owner": ..., "repository": ..., "tag": ...},
+#                   authenticated with "Authorization: Bearer <api token>"
+#   POST /webhook   a Github "release" webhook delivery; published releases are verified
+#   GET  /policy    the current Keylime policy
+#   GET  /health    request, cache hit, coalescing and verification counters
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        if self.path == "/health":
+            with self.server.service._lock:
+                stats = dict(self.server.service.stats)
+            return self._send_json({"status": "ok", "stats": stats})
+        if self.path == "/policy":
+            return self._send(self.server.service.policy_json().encode())
+        self._send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.path == "/verify":
+            api_token = self.server.api_token
+            if not api_token:
+                return self._send_json({"error": "/verify is disabled, the service has no API token"}, 403)
+            if not hmac.compare_digest(f"Bearer {api_token}".encode(), self.headers.get("Authorization", "").encode()):
+                return self._send_json({"error": "invalid API token"}, 401)
+            try:
+                request = json.loads(body or b"{}")
+            except ValueError:
+                return self._send_json({"error": "request body is not valid JSON"}, 400)
+            return self._verify(request)
+        if self.path == "/webhook":
+            return self._webhook(body)
+        self._send_json({"error": "not found"}, 404)
+
+    def _webhook(self, body):
+        secret = self.server.webhook_secret
+        if secret:
+            expected = "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, self.headers.get("X-Hub-Signature-256", "")):
+                return self._send_json({"error": "invalid webhook signature"}, 401)
+
+        try:
+            payload = json.loads(body or b"{}")
+            if self.headers.get("X-GitHub-Event") != "release" or payload.get("action") != "published":
+                return self._send_json({"ignored": True}, 202)
+            request = {
+                "owner": payload["repository"]["owner"]["login"],
+                "repository": payload["repository"]["name"],
+                "tag": payload["release"]["tag_name"],
+            }
+        except (ValueError, KeyError, TypeError):
+            return self._send_json({"error": "malformed release webhook payload"}, 400)
+        self._verify(request)
+
+    def _verify(self, request):
+        try:
+            result = self.server.service.verify(request)
+        except ValueError as e:
+            return self._send_json({"error": str(e)}, 400)
+        except PermissionError as e:
+            return self._send_json({"error": str(e)}, 403)
+        except LookupError as e:
+            return self._send_json({"error": str(e)}, 404)
+        except Exception as e:
+            return self._send_json({"error": str(e)}, 422)
+        self._send_json(result)
+
+    def _send_json(self, obj, status=200):
+        self._send(json.dumps(obj).encode(), status)
+
+    def _send(self, body, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def make_server(service, host=server.DEFAULT_HOST, port=server.DEFAULT_PORT, webhook_secret=None, api_token=None, verbose=False):
+    httpd = ThreadingHTTPServer((host, port), Handler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    httpd.webhook_secret = webhook_secret
+    httpd.api_token = api_token
+    httpd.verbose = verbose
+    return httpd
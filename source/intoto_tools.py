@@ -1,98 +1,236 @@
-import copy, datetime, requests, shutil, sys, tempfile
-from in_toto import verifylib
-from in_toto.models.layout import Layout, Step, Inspection
-from in_toto.models.metadata import Metablock
-from securesystemslib.interface import (generate_and_write_rsa_keypair,
-    import_rsa_privatekey_from_file, import_ed25519_publickey_from_file)
-from .constants import constants
+import collections, datetime, fcntl, hashlib, json, os, shutil, tempfile, threading
+from . import allowlists, cache, trace
+
+# in-toto and securesystemslib are imported by the functions using them, so that
+# runs without in-toto verification (or with "simple" verification) never load them.
+
+# Linux ioctl request cloning one file's extents into another (a reflink).
+FICLONE = 0x40049409
+
+# Where generated default-layout keys and signed layouts are cached, and the
+# password protecting the generated layout key.
+DEFAULT_LAYOUT_CACHE_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "layouts")
+DEFAULT_LAYOUT_KEY_PASSWORD = "123"
+
+# Supply chain step and inspection checked by the default layout.
+DEFAULT_LAYOUT_STEP = {
+    "name": "compile",
+    "functionary": "developer",
+    "expected_command": "go build",
+    "product_rules": ["CREATE hello-go", "DISALLOW *"],
+    "inspection": {"name": "inspect", "run": "echo hello"},
+}
+
+# A cached signed layout is re-signed once it is this close to expiring.
+LAYOUT_EXPIRY_MARGIN = datetime.timedelta(hours=1)
+
+# Serializes default layout generation across batch threads sharing the cache.
+_layout_lock = threading.Lock()
+
+# Number of parsed link indexes kept in memory.
+LINK_INDEX_CACHE_SIZE = 64
+
+# Indexes of parsed links, keyed by the SHA-256 digest of the link file.
+_link_indexes = collections.OrderedDict()
+_link_indexes_lock = threading.Lock()
 
 # Reads an in-toto .link file present at link_path and converts it to a Keylime
-# policy, or appends to an existing policy if provided.
-def convert_link(link_path, policy=None):
-    if not policy:
-        policy = copy.deepcopy(constants.EMPTY_ALLOWLIST)
-        policy["meta"]["timestamp"] = str(datetime.datetime.now())
-        policy["meta"]["generator"] = "keylime-policy-importer"
+# policy, or appends to an existing policy if provided. Products matching
+# excludelist are left out, and its patterns recorded in the policy's excludes.
+def convert_link(link_path, policy=None, excludelist=None):
+    if policy is None:
+        policy = allowlists.get_allowlist()
 
+    from in_toto.models.metadata import Metablock
     link = Metablock.load(link_path)
     artifacts = link.signed.products
 
     for path in artifacts.keys():
-        entrytype = "digests"
-        hash = artifacts[path]["sha256"]
-        if path in policy[entrytype]:
-            policy[entrytype][path].append(hash)
-        else:
-            policy[entrytype][path] = [hash]
+        if excludelist and excludelist.matches(path):
+            continue
+        policy.add(path, artifacts[path]["sha256"])
 
+    if excludelist:
+        allowlists.add_excludes(policy, excludelist)
     return policy
 
-def verify_layout(artifacts, link_urls, id_key_urls, intoto_args):
-    # Dictionary to store all functionary keys
-    functionary_keys = {}
+# Returns the index of the in-toto link file at link_path, whose SHA-256 hex
+# digest is digest: {sha256: [(step, "products" or "materials", path,
+# {algorithm: hex digest})]} over every product and material of the link. Links
+# are parsed once per digest, so large links shared by several releases or
+# verifications are only read again once evicted.
+def index_link(link_path, digest):
+    with _link_indexes_lock:
+        index = _link_indexes.get(digest)
+        if index is not None:
+            _link_indexes.move_to_end(digest)
+            return index
+
+    with trace.span("intoto.index_link", link=os.path.basename(link_path)):
+        with open(link_path, "rb") as f:
+            signed = json.load(f)["signed"]
+        step = signed.get("name")
+        index = {}
+        for role in ("products", "materials"):
+            for path, digests in (signed.get(role) or {}).items():
+                if "sha256" in digests:
+                    index.setdefault(digests["sha256"], []).append((step, role, path, digests))
+
+    with _link_indexes_lock:
+        _link_indexes[digest] = index
+        while len(_link_indexes) > LINK_INDEX_CACHE_SIZE:
+            _link_indexes.popitem(last=False)
+    return index
+
+# Returns the expires timestamp of an in-toto layout ("YYYY-MM-DDTHH:MM:SSZ")
+# as a timezone-aware UTC datetime.
+def parse_expires(expires):
+    return datetime.datetime.strptime(expires, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=datetime.timezone.utc)
+
+# Places the file at src into the verification directory at dest without copying
+# its contents where possible: a hardlink first, then a reflink, then a symlink,
+# and a plain copy only as a last resort.
+def place_file(src, dest):
+    try:
+        os.link(src, dest)
+        return
+    except OSError:
+        pass
+
+    try:
+        with open(src, "rb") as src_file, open(dest, "wb") as dest_file:
+            fcntl.ioctl(dest_file.fileno(), FICLONE, src_file.fileno())
+        return
+    except OSError:
+        if os.path.exists(dest):
+            os.remove(dest)
+
+    try:
+        os.symlink(os.path.abspath(src), dest)
+        return
+    except OSError:
+        pass
+
+    shutil.copyfile(src, dest)
+
+def verify_layout(artifacts, link_urls, id_key_urls, intoto_args, downloader):
+    from in_toto import verifylib
+    from in_toto.models.metadata import Metablock
+    from securesystemslib.interface import import_rsa_privatekey_from_file
 
     # Since in-toto validates files in a directory, use a temporary directory for verification.
     with tempfile.TemporaryDirectory() as tmpdirname:
 
-        # Write artifacts to verification directory
+        # Place artifacts (spooled downloads or local binaries) in verification directory
         for artifact_name in artifacts.keys():
-            with open(f"{tmpdirname}/{artifact_name}", "wb") as f:
-                f.write(artifacts[artifact_name])
+            place_file(artifacts[artifact_name], f"{tmpdirname}/{artifact_name}")
 
-        # Write linkfiles from Github to verification directory
+        # Place linkfiles downloaded from Github in verification directory
         for link in link_urls.keys():
-            link_response = requests.get(link_urls[link]["url"])
-            with open(f"{tmpdirname}/{link_urls[link]['filename']}", "wb") as f:
-                f.write(link_response.content)
+            link_path, _ = downloader.spool(link_urls[link]["url"])
+            place_file(link_path, f"{tmpdirname}/{link_urls[link]['filename']}")
 
-        # Write keyfiles from Github to verification directory
+        # Place keyfiles downloaded from Github in verification directory
         for key_name in id_key_urls.keys():
-            key_response = requests.get(id_key_urls[key_name]["url"])
-            with open(f"{tmpdirname}/{id_key_urls[key_name]['filename']}", "wb") as f:
-                f.write(key_response.content)
+            key_path, _ = downloader.spool(id_key_urls[key_name]["url"])
+            place_file(key_path, f"{tmpdirname}/{id_key_urls[key_name]['filename']}")
 
         if intoto_args.get("layout_path") and intoto_args.get("layout_key"):
             metablock = Metablock.load(intoto_args["layout_path"])
             layout_key = import_rsa_privatekey_from_file(intoto_args["layout_key"], password=intoto_args.get("layout_key_password"))
 
         elif bool(intoto_args.get("layout_path")) ^ bool(intoto_args.get("layout_key")):
-            print("ERROR: Both --intoto and --intoto-key are required for custom layout checks!")
-            sys.exit(1)
+            raise ValueError("Both --intoto and --intoto-key are required for custom layout checks!")
         else:
-            # Create a layout key
-            layout_key_path = generate_and_write_rsa_keypair(password="123", filepath=f"{tmpdirname}/layout_key")
-            layout_key = import_rsa_privatekey_from_file(layout_key_path, password="123")
-
-            layout = Layout()
-
-            # Add functionary keys from Github to layout
-            for key_name in id_key_urls.keys():
-                imported_key = import_ed25519_publickey_from_file(f"{tmpdirname}/{id_key_urls[key_name]['filename']}")
-                functionary_keys[key_name] = layout.add_functionary_key(imported_key)
-
-            layout.set_relative_expiration(days=1)
-
-            step_compile_name = "compile"
-            step_compile = Step(name=step_compile_name)
-            step_compile.pubkeys = [functionary_keys["developer"]["keyid"]]
-
-            step_compile.set_expected_command_from_string("go build")
-
-            step_compile.add_product_rule_from_string("CREATE hello-go")
-            step_compile.add_product_rule_from_string("DISALLOW *")
-
-            inspection = Inspection(name="inspect")
-            inspection.set_run_from_string("echo hello")
-            materials_list = ",".join(artifacts.keys())
-            inspection.add_material_rule_from_string(
-                f"MATCH {materials_list} WITH PRODUCTS FROM {step_compile_name}")
-
-            layout.steps = [step_compile]
-            layout.inspect = [inspection]
-
-            metablock = Metablock(signed=layout)
-            metablock.sign(layout_key)
-            metablock.dump(f"{tmpdirname}/root.layout")
+            functionary_key_paths = {key_name: f"{tmpdirname}/{id_key_urls[key_name]['filename']}" for key_name in id_key_urls.keys()}
+            with trace.span("intoto.default_layout"):
+                metablock, layout_key = get_default_layout(
+                    list(artifacts.keys()),
+                    functionary_key_paths,
+                    intoto_args.get("layout_key_type") or "rsa",
+                    intoto_args.get("layout_cache_dir", DEFAULT_LAYOUT_CACHE_DIR) or tmpdirname
+                )
 
         key_dict = {layout_key["keyid"]: layout_key}
-        verifylib.in_toto_verify(metablock, key_dict, tmpdirname)
+        with trace.span("intoto.in_toto_verify"):
+            verifylib.in_toto_verify(metablock, key_dict, tmpdirname)
+
+# Returns the signed default layout (a Metablock) for the provided artifact
+# names and functionary keys, along with the throwaway key that signed it. The
+# key and signed layout are cached in cache_dir under a digest of the functionary
+# key IDs, artifact names, step definition and key type: a cached layout is
+# reused until it nears expiry, and is then re-signed with the cached key, so a
+# new key is only generated when those inputs change. key_type is "rsa" or
+# "ed25519"; the latter is much faster to generate.
+def get_default_layout(artifact_names, functionary_key_paths, key_type="rsa", cache_dir=DEFAULT_LAYOUT_CACHE_DIR):
+    with _layout_lock:
+        return _get_default_layout(artifact_names, functionary_key_paths, key_type, cache_dir)
+
+def _get_default_layout(artifact_names, functionary_key_paths, key_type, cache_dir):
+    from in_toto.models.layout import Layout, Step, Inspection
+    from in_toto.models.metadata import Metablock
+    from securesystemslib.interface import (generate_and_write_rsa_keypair,
+        generate_and_write_ed25519_keypair, import_rsa_privatekey_from_file,
+        import_ed25519_privatekey_from_file, import_ed25519_publickey_from_file)
+
+    functionary_keys = {key_name: import_ed25519_publickey_from_file(path) for key_name, path in functionary_key_paths.items()}
+
+    cache_key = hashlib.sha256(json.dumps({
+        "functionary_keyids": {key_name: key["keyid"] for key_name, key in functionary_keys.items()},
+        "artifacts": artifact_names,
+        "step": DEFAULT_LAYOUT_STEP,
+        "key_type": key_type,
+    }, sort_keys=True).encode()).hexdigest()
+    layout_dir = os.path.join(cache_dir, cache_key)
+    layout_path = os.path.join(layout_dir, "root.layout")
+    layout_key_path = os.path.join(layout_dir, "layout_key")
+    os.makedirs(layout_dir, exist_ok=True)
+
+    if not os.path.exists(layout_key_path):
+        if key_type == "ed25519":
+            generate_and_write_ed25519_keypair(password=DEFAULT_LAYOUT_KEY_PASSWORD, filepath=layout_key_path)
+        else:
+            generate_and_write_rsa_keypair(password=DEFAULT_LAYOUT_KEY_PASSWORD, filepath=layout_key_path)
+    if key_type == "ed25519":
+        layout_key = import_ed25519_privatekey_from_file(layout_key_path, password=DEFAULT_LAYOUT_KEY_PASSWORD)
+    else:
+        layout_key = import_rsa_privatekey_from_file(layout_key_path, password=DEFAULT_LAYOUT_KEY_PASSWORD)
+
+    if os.path.exists(layout_path):
+        metablock = Metablock.load(layout_path)
+        expires = parse_expires(metablock.signed.expires)
+        if expires - LAYOUT_EXPIRY_MARGIN > datetime.datetime.now(datetime.timezone.utc):
+            print(f"Using cached default layout at {layout_path}")
+            return metablock, layout_key
+
+    layout = Layout()
+
+    # Add functionary keys from Github to layout
+    for key_name in functionary_keys.keys():
+        functionary_keys[key_name] = layout.add_functionary_key(functionary_keys[key_name])
+
+    layout.set_relative_expiration(days=1)
+
+    step_compile_name = DEFAULT_LAYOUT_STEP["name"]
+    step_compile = Step(name=step_compile_name)
+    step_compile.pubkeys = [functionary_keys[DEFAULT_LAYOUT_STEP["functionary"]]["keyid"]]
+
+    step_compile.set_expected_command_from_string(DEFAULT_LAYOUT_STEP["expected_command"])
+
+    for rule in DEFAULT_LAYOUT_STEP["product_rules"]:
+        step_compile.add_product_rule_from_string(rule)
+
+    inspection = Inspection(name=DEFAULT_LAYOUT_STEP["inspection"]["name"])
+    inspection.set_run_from_string(DEFAULT_LAYOUT_STEP["inspection"]["run"])
+    materials_list = ",".join(artifact_names)
+    inspection.add_material_rule_from_string(
+        f"MATCH {materials_list} WITH PRODUCTS FROM {step_compile_name}")
+
+    layout.steps = [step_compile]
+    layout.inspect = [inspection]
+
+    metablock = Metablock(signed=layout)
+    metablock.sign(layout_key)
+    metablock.dump(f"{layout_path}.tmp")
+    os.replace(f"{layout_path}.tmp", layout_path)
+    return metablock, layout_key
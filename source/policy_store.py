@@ -0,0 +1,205 @@
+import copy
+import datetime
+import gzip
+import json
+import os
+import tempfile
+from . import allowlists
+
+DELTA_CURRENT_VERSION = 1
+# Default number of releases a superseded hash stays allowed for; 0 keeps superseded hashes forever.
+DEFAULT_RETIRE_AFTER = 0
+
+# Local history of generated Keylime policies, one gzip-compressed JSON file per
+# value of the policy's "release" counter. The index records the timestamp of
+# every stored version and, for paths allowing several hashes, the release at
+# which each older hash was superseded by a newer one, so superseded hashes can
+# be retired after a number of releases.
+class PolicyStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._index_path = os.path.join(directory, "index.json")
+        os.makedirs(directory, exist_ok=True)
+
+        self._index = {"versions": [], "superseded": {}}
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "r") as f:
+                self._index = json.load(f)
+
+    # Returns the stored versions, oldest first, as [{"release", "timestamp"}].
+    def versions(self):
+        return [dict(v) for v in self._index["versions"]]
+
+    # Returns the release counter of the newest stored version, or None if the store is empty.
+    def latest_release(self):
+        versions = self._index["versions"]
+        return versions[-1]["release"] if versions else None
+
+    def version_path(self, release):
+        return os.path.join(self.directory, f"policy-{release}.json.gz")
+
+    # Returns the stored policy with the given release counter (default: the newest).
+    def load(self, release=None):
+        if release is None:
+            release = self.latest_release()
+        if release is None or not any(v["release"] == release for v in self._index["versions"]):
+            raise LookupError(f"No policy with release {release} in the policy store at {self.directory}")
+        return allowlists.get_allowlist(self.version_path(release))
+
+    # Stores alist as a new version. Its release counter is bumped past both its
+    # own and the newest stored one, and its timestamp is refreshed. Hashes that
+    # were superseded at least retire_after releases ago are removed from alist
+    # first. Returns the new release counter.
+    def commit(self, alist, retire_after=DEFAULT_RETIRE_AFTER):
+        release = max(alist.document.get("release", 0), self.latest_release() or 0) + 1
+        retired = self._retire(alist, release, retire_after)
+        if retired:
+            print(f"Retired {retired} hashes superseded at least {retire_after} releases ago")
+
+        timestamp = str(datetime.datetime.now())
+        alist.document["release"] = release
+        alist.document.setdefault("meta", {})["timestamp"] = timestamp
+        allowlists.save_allowlist(alist, self.version_path(release), True)
+
+        self._index["versions"].append({"release": release, "timestamp": timestamp})
+        self._save()
+        return release
+
+    # Returns the delta between the stored versions from_release and to_release.
+    def delta(self, from_release, to_release=None):
+        return diff(self.load(from_release), self.load(to_release))
+
+    # Records when each hash of a path was first seen superseded, that is when
+    # newer hashes were added to the path without it, and removes those
+    # superseded for at least retire_after releases. Hashes added together
+    # (e.g. digests of one binary in several algorithms) never supersede each
+    # other. Returns the number of hashes removed.
+    def _retire(self, alist, release, retire_after):
+        previous = None
+        superseded = {}
+        retired = 0
+        for path, digests in list(alist.hashes.items()):
+            if not isinstance(digests, tuple):
+                continue
+            # The previous version is only needed once a path allows several hashes.
+            if previous is None and self.latest_release() is not None:
+                previous = self.load()
+            seen = self._index["superseded"].get(path, {})
+            previous_hashes = previous.get(path) if previous else []
+            hashes = alist.get(path)
+            added = [h for h in hashes if previous and h not in previous_hashes]
+            path_superseded = {}
+            for hash in hashes:
+                if hash in added:
+                    continue
+                since = seen.get(hash, release if added else None)
+                if since is None:
+                    continue
+                if retire_after and release - since >= retire_after:
+                    alist.remove(path, hash)
+                    retired += 1
+                else:
+                    path_superseded[hash] = since
+            if path_superseded:
+                superseded[path] = path_superseded
+        self._index["superseded"] = superseded
+        return retired
+
+    def _save(self):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self._index_path)
+
+# Returns the delta turning the allowlist old into new: the hashes added and
+# removed per path and per keyring, and every other section of new that changed.
+def diff(old, new):
+    added, removed = {}, {}
+    for path, digests in new.hashes.items():
+        old_digests = old.hashes.get(path)
+        if digests == old_digests:
+            continue
+        old_hashes = old.get(path)
+        new_hashes = new.get(path)
+        path_added = [h for h in new_hashes if h not in old_hashes]
+        path_removed = [h for h in old_hashes if h not in new_hashes]
+        if path_added:
+            added[path] = path_added
+        if path_removed:
+            removed[path] = path_removed
+    for path in old.hashes:
+        if path not in new.hashes:
+            removed[path] = old.get(path)
+
+    old_keyrings = old.document.get("keyrings", {})
+    new_keyrings = new.document.get("keyrings", {})
+    keyrings_added, keyrings_removed = {}, {}
+    for keyring in new_keyrings.keys() | old_keyrings.keys():
+        old_hashes = old_keyrings.get(keyring, [])
+        new_hashes = new_keyrings.get(keyring, [])
+        keyring_added = [h for h in new_hashes if h not in old_hashes]
+        keyring_removed = [h for h in old_hashes if h not in new_hashes]
+        if keyring_added:
+            keyrings_added[keyring] = keyring_added
+        if keyring_removed:
+            keyrings_removed[keyring] = keyring_removed
+
+    sections = {}
+    for key, value in new.document.items():
+        if key not in ("meta", "release", "hashes", "keyrings") and old.document.get(key) != value:
+            sections[key] = value
+
+    return {
+        "meta": {
+            "version": DELTA_CURRENT_VERSION,
+            "timestamp": str(datetime.datetime.now()),
+            "generator": "keylime-policy-delta",
+        },
+        "from_release": old.document.get("release", 0),
+        "to_release": new.document.get("release", 0),
+        "added": added,
+        "removed": removed,
+        "keyrings_added": keyrings_added,
+        "keyrings_removed": keyrings_removed,
+        "sections": sections,
+    }
+
+# Applies delta to base, which must be the allowlist the delta was generated
+# from, and returns the resulting allowlist. base is left untouched.
+def apply_delta(base, delta):
+    if base.document.get("release", 0) != delta["from_release"]:
+        raise ValueError(f"Delta applies to release {delta['from_release']}, but the base policy is release {base.document.get('release', 0)}")
+
+    result = allowlists.Allowlist({"hashes": {}})
+    result.document = copy.deepcopy(base.document)
+    result.hashes = dict(base.hashes)
+    for path, hashes in delta["removed"].items():
+        for hash in hashes:
+            result.remove(path, hash)
+    for path, hashes in delta["added"].items():
+        for hash in hashes:
+            result.add(path, hash)
+
+    keyrings = result.document.setdefault("keyrings", {})
+    for keyring, hashes in delta["keyrings_removed"].items():
+        keyrings[keyring] = [h for h in keyrings.get(keyring, []) if h not in hashes]
+        if not keyrings[keyring]:
+            del keyrings[keyring]
+    for keyring, hashes in delta["keyrings_added"].items():
+        for hash in hashes:
+            result.add_keyring(keyring, hash)
+
+    result.document.update(copy.deepcopy(delta["sections"]))
+    result.document["release"] = delta["to_release"]
+    result.document.setdefault("meta", {})["timestamp"] = str(datetime.datetime.now())
+    return result
+
+def load_delta(delta_path):
+    opener = gzip.open if delta_path.endswith(".gz") else open
+    with opener(delta_path, "rt") as f:
+        return json.load(f)
+
+def save_delta(delta, delta_path):
+    opener = gzip.open if delta_path.endswith(".gz") else open
+    with opener(delta_path, "wt") as f:
+        json.dump(delta, f)
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from . import cache
+
+# Default location of the verification result store, and how many hours a
+# passing result is trusted before the step it covers is run again.
+DEFAULT_RESULTS_PATH = os.path.join(cache.DEFAULT_CACHE_DIR, "results.sqlite3")
+DEFAULT_TTL = 7 * 24
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    step TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    repository TEXT,
+    tag TEXT,
+    artifact TEXT,
+    sha256 TEXT,
+    passed INTEGER NOT NULL,
+    verified_at REAL NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS results_sha256 ON results (sha256);
+CREATE INDEX IF NOT EXISTS results_verified_at ON results (verified_at);
+"""
+
+_store = None
+
+# Persistent record of verification outcomes, so that steps whose inputs did not
+# change since they last passed are not run again. Each result is keyed by its
+# step ("signature", "sigstore", "rekor" or "intoto"), its mode (e.g. the in-toto
+# layout it was checked against) and the digests of everything the step read:
+# the artifact, its signature and certificate, links, keys and layouts. Results
+# older than ttl seconds are ignored and evicted; with force set, stored results
+# are ignored altogether but fresh ones are still recorded. A result may also
+# carry its own expiry, e.g. that of the in-toto layout it was checked against,
+# after which it is ignored even within the TTL.
+class ResultStore:
+    def __init__(self, path=DEFAULT_RESULTS_PATH, ttl=DEFAULT_TTL * 3600, force=False):
+        self.path = path
+        self.ttl = ttl
+        self.force = force
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # The store is shared by batch and server worker threads, and possibly
+        # by several processes, so writes are serialized and journaled with WAL.
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        # Stores created before results could expire lack the column.
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(results)")]
+        if "expires_at" not in columns:
+            self._db.execute("ALTER TABLE results ADD COLUMN expires_at REAL")
+        self.evict()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    # Returns whether step last passed on exactly these inputs within the TTL,
+    # and before the result's own expiry.
+    def passed(self, step, mode, inputs):
+        if self.force:
+            return False
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT passed FROM results WHERE key = ? AND verified_at >= ? AND (expires_at IS NULL OR expires_at > ?)",
+                (result_key(step, mode, inputs), now - self.ttl, now)).fetchone()
+        return bool(row and row[0])
+
+    # Records the outcome of step on inputs. expires_at (a Unix timestamp), if
+    # given, is when the result stops being reused regardless of the TTL.
+    # repository, tag, artifact and sha256 only describe the result for list.
+    def record(self, step, mode, inputs, passed, repository=None, tag=None, artifact=None, sha256=None, expires_at=None):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO results (key, step, mode, repository, tag, artifact, sha256, passed, verified_at, expires_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (result_key(step, mode, inputs), step, mode, repository, tag, artifact, sha256, int(bool(passed)), time.time(), expires_at))
+
+    # Removes results older than the TTL. Returns the number removed.
+    def evict(self):
+        with self._lock, self._db:
+            return self._db.execute("DELETE FROM results WHERE verified_at < ?", (time.time() - self.ttl,)).rowcount
+
+    # Returns stored results, newest first, as dictionaries. Results can be
+    # narrowed to a repository ("owner/repo"), a tag and an artifact SHA-256
+    # digest (or a prefix of it).
+    def list(self, repository=None, tag=None, sha256=None):
+        query = "SELECT step, mode, repository, tag, artifact, sha256, passed, verified_at FROM results WHERE 1"
+        params = []
+        if repository:
+            query += " AND repository = ?"
+            params.append(repository)
+        if tag:
+            query += " AND tag = ?"
+            params.append(tag)
+        if sha256:
+            query += " AND sha256 LIKE ?"
+            params.append(sha256.lower() + "%")
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY verified_at DESC", params).fetchall()
+        columns = ("step", "mode", "repository", "tag", "artifact", "sha256", "passed", "verified_at")
+        return [dict(zip(columns, row), passed=bool(row[6])) for row in rows]
+
+# Returns the key a result of step in mode on inputs is stored under.
+def result_key(step, mode, inputs):
+    return hashlib.sha256(json.dumps([step, mode, inputs]).encode()).hexdigest()
+
+# Returns the SHA-256 hex digest of raw (bytes or text), e.g. a signature or certificate.
+def digest(raw):
+    if isinstance(raw, str):
+        raw = raw.encode()
+    return hashlib.sha256(raw).hexdigest()
+
+# Enables the result store for the rest of the process. Returns the store.
+def configure(path=DEFAULT_RESULTS_PATH, ttl=DEFAULT_TTL * 3600, force=False):
+    global _store
+    close()
+    _store = ResultStore(path, ttl, force)
+    return _store
+
+# Closes and disables the current result store, if any.
+def close():
+    global _store
+    if _store:
+        _store.close()
+        _store = None
+
+# Returns the result store configured for this process, or None.
+def get_store():
+    return _store
@@ -0,0 +1,202 @@
+import collections
+import io
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from . import allowlists, artifacts, batch, github, intoto_tools, trace
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8787
+# Number of verifications run at once; further requests queue for a worker.
+DEFAULT_SERVER_WORKERS = 4
+# Seconds the resolved latest release of a repository is reused before Github is asked again.
+DEFAULT_RELEASE_TTL = 60
+# Number of verified results (and resolved releases) kept in memory.
+DEFAULT_MAX_RESULTS = 1024
+
+# Manifest entry keys that change the outcome of a verification, and so are part
+# of the key verified results are cached and coalesced under.
+VERIFY_OPTIONS = ("local_app_path", "intoto", "intoto_key", "intoto_key_password", "layout_key_type", "sigstore")
+# Manifest entry keys a request may not change for a repository listed in the
+# server's manifest, so that callers cannot weaken its checks or redirect where
+# its hashes are added to the policy.
+MANIFEST_OPTIONS = VERIFY_OPTIONS + ("destination_app_path",)
+# Manifest entry keys naming paths on this host, which only the server's
+# manifest may set.
+LOCAL_PATH_OPTIONS = ("destination_app_path", "local_app_path")
+
+# Verifies releases on behalf of the HTTP API (see http_api), keeping everything a cold CLI run
+# has to set up warm between requests: the downloader's pooled session and
+# asset cache, the process-wide Sigstore verifier, resolved releases and
+# verified results. Concurrent requests for the same release and options are
+# collapsed into a single verification run on a pool of workers threads.
+# Requests are manifest entries (see batch.load_manifest) without
+# LOCAL_PATH_OPTIONS. If the server has a manifest, only repositories listed in
+# it are verified, and their entries provide the tag default and fix their
+# MANIFEST_OPTIONS, which requests are rejected for changing. Verified hashes
+# of entries with a destination_app_path are appended to policy, which is
+# written to policy_path (and committed to store, if given) whenever it changes.
+# Default in-toto layouts are cached in layout_cache_dir (see batch.verify_entry).
+class VerificationService:
+    def __init__(self, token, downloader, policy, policy_path, entries=(), workers=DEFAULT_SERVER_WORKERS,
+                 release_ttl=DEFAULT_RELEASE_TTL, max_results=DEFAULT_MAX_RESULTS, hash_algorithms=("sha256",),
+                 excludelist=None, compress=False, store=None, retire_after=0,
+                 layout_cache_dir=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR):
+        self.token = token
+        self.downloader = downloader
+        self.policy = policy
+        self.policy_path = policy_path
+        self.defaults = {(entry["owner"], entry["repository"]): entry for entry in entries}
+        self.release_ttl = release_ttl
+        self.max_results = max_results
+        self.hash_algorithms = hash_algorithms
+        self.excludelist = excludelist
+        self.compress = compress
+        self.store = store
+        self.retire_after = retire_after
+        self.layout_cache_dir = layout_cache_dir
+        self.stats = collections.Counter()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._policy_lock = threading.Lock()
+        self._inflight = {}
+        self._results = collections.OrderedDict()
+        self._releases = collections.OrderedDict()
+        self._latest = {}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    # Verifies the release described by request, a manifest entry, and amends
+    # the policy with its verified hashes. Returns the result as a dictionary.
+    def verify(self, request):
+        if not request.get("owner") or not request.get("repository"):
+            raise ValueError("Both owner and repository are required")
+        name = f"{request['owner']}/{request['repository']}"
+        local = [option for option in LOCAL_PATH_OPTIONS if option in request]
+        if local:
+            raise ValueError(f"{', '.join(local)} can only be set in the server's manifest")
+        defaults = self.defaults.get((request["owner"], request["repository"]))
+        if self.defaults and defaults is None:
+            raise PermissionError(f"{name} is not listed in the server's manifest")
+        if defaults is not None:
+            overridden = [option for option in MANIFEST_OPTIONS if option in request and request[option] != defaults.get(option)]
+            if overridden:
+                raise ValueError(f"{name} is configured by the server's manifest, its {', '.join(overridden)} cannot be changed")
+        entry = dict(defaults or {}, **request)
+        self._count("requests")
+
+        with trace.span("server.verify", owner=entry["owner"], repo=entry["repository"], tag=entry.get("tag")) as span:
+            tag, links = self._release(entry["owner"], entry["repository"], entry.get("tag"))
+            key = json.dumps([entry["owner"], entry["repository"], tag] + [entry.get(option) for option in VERIFY_OPTIONS])
+            with self._lock:
+                cached = self._results.get(key)
+                if cached is not None:
+                    self._results.move_to_end(key)
+            if cached is not None:
+                self._count("cache_hits")
+                span.add("cache_hits")
+                verified_digests = cached
+            else:
+                span.add("cache_misses")
+                verified_digests = self._once(("verify", key), lambda: self._executor.submit(self._verify, key, entry, links, tag).result())
+
+        return {
+            "owner": entry["owner"],
+            "repository": entry["repository"],
+            "tag": tag,
+            "verified_hashes": [digests["sha256"] for digests in verified_digests],
+            "verified_digests": verified_digests,
+            "cached": cached is not None,
+            "policy_amended": self._amend(entry, verified_digests),
+        }
+
+    # Returns the policy as a JSON string.
+    def policy_json(self):
+        with self._policy_lock:
+            output = io.StringIO()
+            allowlists.write_allowlist_json(self.policy, output)
+            return output.getvalue()
+
+    def _verify(self, key, entry, links, tag):
+        self._count("verifications")
+        try:
+            verified_digests = batch.verify_entry(entry, self.token, self.downloader, links, tag, self.layout_cache_dir)
+        except Exception:
+            self._count("failures")
+            raise
+        if not verified_digests:
+            self._count("failures")
+            raise artifacts.VerificationError("no artifact hashes were verified")
+        with self._lock:
+            self._results[key] = verified_digests
+            while len(self._results) > self.max_results:
+                self._results.popitem(last=False)
+        return verified_digests
+
+    # Returns the (tag, links) of the release of owner/repo tagged tag, or of its
+    # latest release. Tagged releases are kept until evicted; the latest release
+    # is looked up again once it is older than release_ttl.
+    def _release(self, owner, repo, tag):
+        with self._lock:
+            if tag:
+                links = self._releases.get((owner, repo, tag))
+                if links is not None:
+                    self._releases.move_to_end((owner, repo, tag))
+                    return tag, links
+            else:
+                latest = self._latest.get((owner, repo))
+                if latest and latest[0] > time.monotonic():
+                    return latest[1], latest[2]
+
+        release = self._once(("release", owner, repo, tag), lambda: github.fetch_release(owner, repo, self.token, tag))
+        links = github.organize_assets(release["assets"])
+        with self._lock:
+            if not tag:
+                self._latest[(owner, repo)] = (time.monotonic() + self.release_ttl, release["tag"], links)
+            self._releases[(owner, repo, release["tag"])] = links
+            while len(self._releases) > self.max_results:
+                self._releases.popitem(last=False)
+        return release["tag"], links
+
+    # Runs fn unless a call with the same key is already in flight, in which case
+    # its result is shared instead.
+    def _once(self, key, fn):
+        with self._lock:
+            future = self._inflight.get(key)
+            first = future is None
+            if first:
+                future = self._inflight[key] = Future()
+        if not first:
+            self._count("coalesced")
+            return future.result()
+
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+        return future.result()
+
+    # Appends the first verified digests to the policy under the entry's
+    # destination_app_path. Returns whether the policy changed.
+    def _amend(self, entry, verified_digests):
+        path = entry.get("destination_app_path")
+        if not path or (self.excludelist and self.excludelist.matches(path)):
+            return False
+        with self._policy_lock:
+            before = self.policy.get(path)
+            allowlists.append_digests_to_allowlist(self.policy, path, verified_digests[0], self.hash_algorithms)
+            if self.policy.get(path) == before:
+                return False
+            if self.store:
+                self.store.commit(self.policy, self.retire_after)
+            allowlists.save_allowlist(self.policy, self.policy_path, self.compress)
+        return True
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
@@ -1,25 +1,44 @@
 import base64
+import collections
 import hashlib
 import json
+import mmap
+import os
+import threading
+import time
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.serialization import load_pem_private_key
-from cryptography.exceptions import InvalidSignature
-from cryptography.x509 import load_pem_x509_certificate
+from concurrent.futures import ThreadPoolExecutor
 from os.path import exists
 from typing import cast
+from . import trace
 from .sigstore import merkle, sigstore_shim
 
-from sigstore._verify import (
-    CertificateVerificationFailure,
-    VerificationFailure,
-    Verifier,
-)
+# cryptography and sigstore-python are imported by the functions using them, so
+# that runs which never check a signature do not pay for loading them.
+
+# Number of concurrent Rekor index searches and bulk retrieve requests.
+REKOR_WORKERS = 8
+# Number of threads checking artifact signatures at once. The crypto backend
+# releases the GIL while verifying, so checks spread across cores.
+SIGNATURE_WORKERS = os.cpu_count() or 1
+# Number of parsed certificates kept in memory.
+CERT_CACHE_SIZE = 256
+
+# Verifier shared by every artifact, created by get_verifier on first use.
+_verifier = None
+_verifier_lock = threading.Lock()
+
+# Public keys of parsed certificates, keyed by certificate fingerprint.
+_public_keys = collections.OrderedDict()
+_public_keys_lock = threading.Lock()
 
 # Signs an artifact with private key located at keypath.
 def sign(artifact, keypath):
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
     if not exists(keypath):
         print(f"Private key not found at {keypath}")
         exit(1)
@@ -43,80 +62,167 @@ def sign(artifact, keypath):
         "sig": base64.b64encode(artifact_signature)
     }
 
-# Verifies provided artifact against provided signature using pubkey found in provided certificate.
-def verify_hash_with_cert(artifact_raw, sig_raw, crt_raw):
-    sig = base64.b64decode(sig_raw)
-    crt = load_pem_x509_certificate(crt_raw)
-
-    try:
-        crt.public_key().verify(
-            sig,
-            artifact_raw,
-            ec.ECDSA(hashes.SHA256())
-        )
+# Returns the public key of the PEM certificate crt_raw. Certificates are parsed
+# once and kept by fingerprint, as every asset of a release is usually signed
+# with the same one.
+def load_public_key(crt_raw):
+    if isinstance(crt_raw, str):
+        crt_raw = crt_raw.encode()
+    fingerprint = hashlib.sha256(crt_raw).digest()
+    with _public_keys_lock:
+        public_key = _public_keys.get(fingerprint)
+        if public_key is not None:
+            _public_keys.move_to_end(fingerprint)
+            return public_key
+
+    from cryptography.x509 import load_pem_x509_certificate
+    with trace.span("signing.load_certificate"):
+        public_key = load_pem_x509_certificate(crt_raw).public_key()
+    with _public_keys_lock:
+        _public_keys[fingerprint] = public_key
+        while len(_public_keys) > CERT_CACHE_SIZE:
+            _public_keys.popitem(last=False)
+    return public_key
+
+# Verifies provided artifact SHA-256 hex digest against provided signature using
+# pubkey found in provided certificate. The signature is checked against the
+# prehashed digest, so the artifact itself never needs to be in memory.
+def verify_hash_with_cert(artifact_hash, sig_raw, crt_raw):
+    verified = _check_signature(artifact_hash, sig_raw, crt_raw) is None
+    if verified:
         print("Artifact signature validation passed!")
-        verified = True
-    except InvalidSignature:
+    else:
         print("Artifact signature validation failed!")
-        verified = False
-
     return verified
 
-# Verifies provided artifact for inclusion in the Sigstore transparency log.
-def verify_inclusion_proof(artifact_raw, sig_raw, crt_raw):
-    sig = base64.b64decode(sig_raw)
-    pubkey = load_pem_x509_certificate(crt_raw).public_key()
-    artifact_hash = hashlib.sha256(artifact_raw).hexdigest()
-
-    search_response = sigstore_shim.search(hash=artifact_hash)
-    uuids = json.loads(search_response.content)
+# Verifies the signatures of many artifacts at once on a pool of workers
+# threads. artifacts maps a name to its (SHA-256 hex digest, signature,
+# certificate). Returns a dictionary mapping each name to None if its signature
+# verified, or to the reason it did not.
+def verify_signatures(artifacts, workers=SIGNATURE_WORKERS):
+    names = list(artifacts.keys())
+    with trace.span("signing.verify_signatures", artifacts=len(names)):
+        if len(names) < 2 or workers < 2:
+            return {name: _check_signature(*artifacts[name]) for name in names}
+        with ThreadPoolExecutor(max_workers=min(workers, len(names))) as executor:
+            return dict(zip(names, executor.map(lambda name: _check_signature(*artifacts[name]), names)))
+
+# Returns None if sig_raw is a valid signature of artifact_hash by the key of
+# crt_raw, or the reason it is not.
+def _check_signature(artifact_hash, sig_raw, crt_raw):
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, utils
 
-    print(f'Found Rekor entries matching provided artifact hash. Verifying...')
-
-    for uuid in uuids:
-
-        fetch_uuid_response = sigstore_shim.fetch_with_uuid(uuid=uuid)
+    try:
+        sig = base64.b64decode(sig_raw)
+        public_key = load_public_key(crt_raw)
+    except ValueError as e:
+        return f"malformed signature or certificate: {e}"
 
-        entries = json.loads(fetch_uuid_response.content)
-        for key in entries.keys():
-            entry = entries[key]
+    try:
+        public_key.verify(
+            sig,
+            bytes.fromhex(artifact_hash),
+            ec.ECDSA(utils.Prehashed(hashes.SHA256()))
+        )
+    except InvalidSignature:
+        return "signature does not match the artifact digest"
+    except (TypeError, ValueError) as e:
+        return f"signature could not be checked: {e}"
+    return None
+
+# Verifies provided artifact SHA-256 hex digest for inclusion in the Sigstore transparency log.
+def verify_inclusion_proof(artifact_hash, sig_raw, crt_raw):
+    return verify_inclusion_proofs({artifact_hash: (artifact_hash, sig_raw, crt_raw)})[artifact_hash]
+
+# Verifies inclusion in the Sigstore transparency log for many artifacts at once.
+# artifacts maps a name to its (SHA-256 hex digest, signature, certificate). Rekor
+# index searches run concurrently, and the candidate entries of all artifacts are
+# then fetched with as few bulk retrieve requests as possible. Returns a
+# dictionary mapping each name to whether its inclusion proof verified.
+def verify_inclusion_proofs(artifacts, workers=REKOR_WORKERS):
+    names = list(artifacts.keys())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        search_responses = executor.map(lambda name: sigstore_shim.search(hash=artifacts[name][0]), names)
+        uuids = {name: json.loads(response.content) for name, response in zip(names, search_responses)}
+
+        # Search results may or may not carry the tree ID prefix, so index
+        # fetched entries by the trailing 64-character leaf hash.
+        unique_uuids = list(dict.fromkeys(uuid for name in names for uuid in uuids[name]))
+        batches = [unique_uuids[i:i + sigstore_shim.RETRIEVE_BATCH_SIZE] for i in range(0, len(unique_uuids), sigstore_shim.RETRIEVE_BATCH_SIZE)]
+        entries = {}
+        for response in executor.map(sigstore_shim.fetch_with_uuids, batches):
+            for fetched in json.loads(response.content):
+                for key, entry in fetched.items():
+                    entries[key[-64:]] = entry
+
+    results = {}
+    for name in names:
+        artifact_hash, sig_raw, crt_raw = artifacts[name]
+        pubkey = load_public_key(crt_raw)
+        print(f'{name}: Found {len(uuids[name])} Rekor entries matching artifact hash. Verifying...')
+        candidates = [(uuid, entries[uuid[-64:]]) for uuid in uuids[name] if uuid[-64:] in entries]
+        results[name] = _verify_rekor_entries(artifact_hash, pubkey, candidates)
+    return results
+
+def _verify_rekor_entries(artifact_hash, pubkey, candidates):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec, utils
+
+    for uuid, entry in candidates:
         encoded_rekord = entry["body"]
         rekor_cert = json.loads(base64.b64decode(encoded_rekord))['spec']['signature']['content']
 
-        valid_signature_found = False
         try:
-            pubkey.verify(base64.b64decode(rekor_cert), artifact_raw, ec.ECDSA(hashes.SHA256()))
+            pubkey.verify(base64.b64decode(rekor_cert), bytes.fromhex(artifact_hash), ec.ECDSA(utils.Prehashed(hashes.SHA256())))
             print(f'{uuid[:16]}: Rekor signature validation: PASS')
-            valid_signature_found = True
         except Exception as e:
             continue
 
-        if valid_signature_found:
-            try:
-                merkle.verify_merkle_inclusion(entry)
-                print("Inclusion proof verified!")
-                return True
-            except merkle.InvalidInclusionProofError as e:
-                print("Inclusion proof failed to verify!")
-                print(e)
-                return False
-        else:
-            print("No valid signature was found in any of the fetched Rekor entries!")
+        try:
+            merkle.verify_merkle_inclusion(entry)
+            print("Inclusion proof verified!")
+            return True
+        except merkle.InvalidInclusionProofError as e:
+            print("Inclusion proof failed to verify!")
+            print(e)
             return False
 
-# Verifies provided artifact against Sigstore using the sigstore-python library.
-def verify_sigstore_python(artifact_raw, sig_raw, crt_raw):
-    verifier = Verifier.production()
-
-    result = verifier.verify(
-        input_=artifact_raw,
-        certificate=crt_raw,
-        signature=sig_raw
-    )
+    print("No valid signature was found in any of the fetched Rekor entries!")
+    return False
+
+# Returns the process-wide Sigstore Verifier, creating it on first use. The
+# sigstore._verify API loads its trust root (Fulcio certificates, Rekor and CT
+# log keys) from the copy bundled with sigstore-python, so building the verifier
+# once per process is all that can be saved.
+def get_verifier():
+    global _verifier
+    with _verifier_lock:
+        if _verifier is None:
+            from sigstore._verify import Verifier
+            start = time.monotonic()
+            with trace.span("sigstore.load_trust_root"):
+                _verifier = Verifier.production()
+            print(f"Sigstore verifier ready in {time.monotonic() - start:.2f}s")
+        return _verifier
+
+# Verifies artifact present at artifact_path against Sigstore using the sigstore-python
+# library. The artifact is memory-mapped rather than read into memory.
+def verify_sigstore_python(artifact_path, sig_raw, crt_raw):
+    verifier = get_verifier()
+
+    with open(artifact_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as artifact_raw:
+        result = verifier.verify(
+            input_=artifact_raw,
+            certificate=crt_raw,
+            signature=sig_raw
+        )
 
     if result:
         return True
     else:
+        from sigstore._verify import VerificationFailure
         result = cast(VerificationFailure, result)
         print(f"FAIL")
         print(f"Failure reason: {result.reason}")
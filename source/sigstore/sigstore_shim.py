@@ -1,13 +1,21 @@
 import base64
 import hashlib
-import requests
+import os
+import threading
 import simplejson as json
 
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import ec
+from .. import trace
 
-REKOR_URL = "https://rekor.sigstore.dev"
+# Base URL of the Rekor instance, overridable with the REKOR_URL environment variable.
+REKOR_URL = os.getenv("REKOR_URL", "https://rekor.sigstore.dev")
+
+# Rekor accepts at most this many entry UUIDs per bulk retrieve request.
+RETRIEVE_BATCH_SIZE = 10
+
+# Pooled keep-alive session shared by every Rekor call, created on first use
+# so that runs which never talk to Rekor do not load requests.
+_session = None
+_session_lock = threading.Lock()
 
 REKOR_API_HEADERS = {
     'Content-Type': 'application/json',
@@ -15,6 +23,9 @@ REKOR_API_HEADERS = {
 }
 
 def sign_offline_and_upload(private_key, artifact):
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+
     public_key = private_key.public_key()
 
     # Sign artifact
@@ -58,7 +69,7 @@ def sign_offline_and_upload(private_key, artifact):
 
     return {
         "signature": artifact_signature,
-        "response": requests.post(f"{REKOR_URL}/api/v1/log/entries", data=payload,  headers=REKOR_API_HEADERS),
+        "response": _request("post", f"{REKOR_URL}/api/v1/log/entries", data=payload,  headers=REKOR_API_HEADERS),
     }
 
 def search(email=None, pubkey=None, hash=None):
@@ -77,10 +88,15 @@ def search(email=None, pubkey=None, hash=None):
     }
     payload = json.dumps(rekor_payload_search)
 
-    return requests.post(f"{REKOR_URL}/api/v1/index/retrieve", data=payload,  headers=REKOR_API_HEADERS)
+    return _request("post", f"{REKOR_URL}/api/v1/index/retrieve", data=payload,  headers=REKOR_API_HEADERS)
 
 def fetch_with_uuid(uuid):
-    return requests.get(f"{REKOR_URL}/api/v1/log/entries/{uuid}",  headers=REKOR_API_HEADERS)
+    return _request("get", f"{REKOR_URL}/api/v1/log/entries/{uuid}",  headers=REKOR_API_HEADERS)
+
+# Fetches up to RETRIEVE_BATCH_SIZE entries in one request using the bulk retrieve endpoint.
+def fetch_with_uuids(uuids):
+    payload = json.dumps({"entryUUIDs": uuids})
+    return _request("post", f"{REKOR_URL}/api/v1/log/entries/retrieve", data=payload,  headers=REKOR_API_HEADERS)
 
 def fetch_with_inputs(signature, pubkey, hash):
     artifact_signature_b64 = base64.b64encode(signature)
@@ -110,9 +126,30 @@ def fetch_with_inputs(signature, pubkey, hash):
     }
     payload = json.dumps(rekor_payload_search)
 
-    return requests.post(f"{REKOR_URL}/api/v1/log/entries/retrieve", data=payload,  headers=REKOR_API_HEADERS)
+    return _request("post", f"{REKOR_URL}/api/v1/log/entries/retrieve", data=payload,  headers=REKOR_API_HEADERS)
+
+# Sends a request to Rekor over the shared session within a trace span.
+def _request(method, url, **kwargs):
+    with trace.span("rekor.request", url=url) as span:
+        response = _get_session().request(method, url, **kwargs)
+        span.add("http_requests")
+        span.add("bytes", len(response.content))
+        return response
+
+def _get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            _session = requests.Session()
+            _session.mount("https://", HTTPAdapter(pool_maxsize=16))
+            _session.mount("http://", HTTPAdapter(pool_maxsize=16))
+        return _session
 
 def _encode_pubkey(pubkey):
+    from cryptography.hazmat.primitives import serialization
+
     # serializing into PEM
     rsa_pem = pubkey.public_bytes(encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo)
     pub_pem = rsa_pem.decode("utf-8").replace("\\n", "")
@@ -0,0 +1,174 @@
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+
+# Formats a trace can be written in: one JSON object per span and line, or a
+# Chrome trace (viewable in chrome://tracing or https://ui.perfetto.dev).
+FORMATS = ("jsonl", "chrome")
+
+_tracer = None
+
+# Records timed spans of the bridge's stages. Each span keeps its wall time,
+# thread, parent span, attributes (e.g. the artifact it covers), counters added
+# while it ran (bytes, http_requests, cache_hits, cache_misses...) and the peak
+# RSS of the process when it ended. Spans named in profile are additionally run
+# under cProfile, and their stats dumped to profile_dir.
+class Tracer:
+    def __init__(self, path=None, format="jsonl", profile=(), profile_dir="."):
+        if format not in FORMATS:
+            raise ValueError(f"Unknown trace format {format} (valid: {', '.join(FORMATS)})")
+        self.path = path
+        self.format = format
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.totals = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._origin = time.perf_counter()
+        self._profiles = 0
+        self._file = open(path, "w") if path and format == "jsonl" else None
+        if self.profile:
+            os.makedirs(profile_dir, exist_ok=True)
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def close(self):
+        with self._lock:
+            summary = {"type": "summary", "totals": self.totals, "peak_rss": _peak_rss()}
+            if self._file:
+                self._file.write(json.dumps(summary) + "\n")
+                self._file.close()
+                self._file = None
+            elif self.path:
+                with open(self.path, "w") as f:
+                    json.dump({"traceEvents": self._events, "otherData": summary}, f)
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _record(self, span):
+        with self._lock:
+            for counter, value in span.counters.items():
+                self.totals[counter] = self.totals.get(counter, 0) + value
+            if self._file:
+                self._file.write(json.dumps({
+                    "type": "span",
+                    "name": span.name,
+                    "id": span.id,
+                    "parent": span.parent,
+                    "thread": span.thread,
+                    "start": span.start - self._origin,
+                    "duration": span.duration,
+                    "attrs": span.attrs,
+                    "counters": span.counters,
+                    "peak_rss": span.peak_rss,
+                }, default=str) + "\n")
+            elif self.path:
+                self._events.append({
+                    "name": span.name,
+                    "ph": "X",
+                    "ts": (span.start - self._origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": span.thread,
+                    "args": dict(span.attrs, **span.counters, peak_rss=span.peak_rss),
+                })
+
+    def _profile_path(self, name):
+        with self._lock:
+            self._profiles += 1
+            return os.path.join(self.profile_dir, f"{name}.{self._profiles}.prof")
+
+class Span:
+    _ids = iter(range(1, 2**63))
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.counters = {}
+        self._profiler = None
+
+    def __enter__(self):
+        stack = self.tracer._stack()
+        self.id = next(Span._ids)
+        self.parent = stack[-1].id if stack else None
+        self.thread = threading.get_ident()
+        stack.append(self)
+        if self.name in self.tracer.profile:
+            self._profiler = cProfile.Profile()
+            try:
+                self._profiler.enable()
+            except ValueError:
+                # Another profiler (e.g. an enclosing profiled span) is already active.
+                self._profiler = None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.start
+        if self._profiler:
+            self._profiler.disable()
+            self._profiler.dump_stats(self.tracer._profile_path(self.name))
+        self.peak_rss = _peak_rss()
+        self.tracer._stack().pop()
+        self.tracer._record(self)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+# Stand-in for spans while tracing is disabled, so that instrumented code costs
+# a function call and nothing more.
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, counter, value=1):
+        pass
+
+_NULL_SPAN = _NullSpan()
+
+# Enables tracing for the rest of the process. Returns the tracer.
+def configure(path=None, format="jsonl", profile=(), profile_dir="."):
+    global _tracer
+    _tracer = Tracer(path, format, profile, profile_dir)
+    return _tracer
+
+# Writes out and disables the current trace, if any.
+def close():
+    global _tracer
+    if _tracer:
+        _tracer.close()
+        _tracer = None
+
+# Returns a context manager timing the stage name, e.g.
+#
+#   with trace.span("download", url=url) as span:
+#       span.add("bytes", len(chunk))
+#
+# or a no-op one if tracing is disabled.
+def span(name, **attrs):
+    if _tracer is None:
+        return _NULL_SPAN
+    return _tracer.span(name, **attrs)
+
+# Returns the peak resident set size of the process in bytes.
+def _peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import mmap
+import os
+import stat
+import tempfile
+from . import cache, downloads, trace
+
+# Where the per-tree index of already-hashed files is kept by default.
+DEFAULT_INDEX_DIR = os.path.join(cache.DEFAULT_CACHE_DIR, "trees")
+# Files at least this large are hashed through mmap instead of read in chunks.
+MMAP_THRESHOLD = 16 * 1024 * 1024
+# Number of files, or bytes, handed to a hashing process at a time.
+HASH_BATCH_FILES = 512
+HASH_BATCH_BYTES = 256 * 1024 * 1024
+
+# Returns the default index path for the tree rooted at root.
+def default_index_path(root):
+    return os.path.join(DEFAULT_INDEX_DIR, hashlib.sha256(os.path.abspath(root).encode()).hexdigest() + ".json")
+
+# Hashes every regular file under root with each of algorithms on a pool of
+# workers processes, and returns {relative path: {algorithm: hex digest}}.
+# Symlinks are not followed, and files whose policy path (prefix joined with
+# their relative path) matches excludelist are skipped. If index_path is given,
+# the size, mtime and digests of every file are recorded there, and files whose
+# size and mtime did not change since the last run are not hashed again.
+def hash_tree(root, algorithms=downloads.DEFAULT_ALGORITHMS, excludelist=None, index_path=None, workers=None, prefix="/"):
+    index = _load_index(index_path) if index_path else {}
+    digests = {}
+    pending = []
+    skipped = 0
+    with trace.span("tree.walk", root=root) as span:
+        for relative_path, st in _walk(root):
+            if excludelist and excludelist.matches(policy_path(relative_path, prefix)):
+                continue
+            entry = index.get(relative_path)
+            if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns and all(a in entry[2] for a in algorithms):
+                digests[relative_path] = {a: entry[2][a] for a in algorithms}
+                skipped += 1
+            else:
+                pending.append((relative_path, st.st_size, st.st_mtime_ns))
+        span.add("cache_hits", skipped)
+        span.add("cache_misses", len(pending))
+
+    print(f"Hashing {len(pending)} files under {root} ({skipped} unchanged since the last run)")
+    from concurrent.futures import ProcessPoolExecutor
+    failed = 0
+    batches = list(_batches(pending))
+    with trace.span("tree.hash", files=len(pending)) as span, ProcessPoolExecutor(max_workers=workers) as executor:
+        span.add("bytes", sum(size for _, size, _ in pending))
+        futures = [executor.submit(_hash_batch, root, [p for p, _, _ in batch], algorithms) for batch in batches]
+        for batch, future in zip(batches, futures):
+            for (relative_path, size, mtime_ns), file_digests in zip(batch, future.result()):
+                if file_digests is None:
+                    failed += 1
+                    continue
+                digests[relative_path] = file_digests
+                index[relative_path] = [size, mtime_ns, file_digests]
+    if failed:
+        print(f"WARNING: {failed} files under {root} could not be read and were skipped")
+
+    if index_path:
+        # Files that disappeared from the tree are dropped from the index.
+        _save_index(index_path, {p: index[p] for p in digests if p in index})
+    return digests
+
+# Returns the policy path of the file at relative_path in a tree mounted at prefix.
+def policy_path(relative_path, prefix="/"):
+    return os.path.join(prefix, relative_path)
+
+# Adds the digests of every hashed file (see hash_tree) to alist under its
+# policy path, in each of algorithms.
+def add_to_allowlist(alist, digests, algorithms=downloads.DEFAULT_ALGORITHMS, prefix="/"):
+    for relative_path, file_digests in digests.items():
+        path = policy_path(relative_path, prefix)
+        for algorithm in algorithms:
+            alist.add(path, file_digests[algorithm])
+    return alist
+
+# Compares the hashed files of a tree (see hash_tree) against the products of an
+# in-toto link, on every algorithm both record. Returns a report with the
+# number of matching products and the lists of mismatched products, products
+# missing from the tree and files of the tree that are not products.
+def diff_against_products(digests, products):
+    products = {os.path.normpath(path): product for path, product in products.items()}
+    matching = 0
+    mismatched = []
+    missing = []
+    for path, product in products.items():
+        file_digests = digests.get(path)
+        if file_digests is None:
+            missing.append(path)
+            continue
+        common = [a for a in product if a in file_digests]
+        if not common:
+            missing.append(path)
+        elif all(product[a] == file_digests[a] for a in common):
+            matching += 1
+        else:
+            mismatched.append(path)
+    extra = [path for path in digests if path not in products]
+    return {"matching": matching, "mismatched": mismatched, "missing": missing, "extra": extra}
+
+# Yields (path relative to root, stat result) for every regular file under root.
+def _walk(root):
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        try:
+            entries = os.scandir(os.path.join(root, relative_dir))
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                relative_path = os.path.join(relative_dir, entry.name)
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(relative_path)
+                elif stat.S_ISREG(st.st_mode):
+                    yield relative_path, st
+
+# Splits pending files into batches of at most HASH_BATCH_FILES files or
+# HASH_BATCH_BYTES bytes, so that process pool overhead stays small while
+# large files are spread across workers.
+def _batches(pending):
+    batch = []
+    batch_bytes = 0
+    for item in pending:
+        batch.append(item)
+        batch_bytes += item[1]
+        if len(batch) == HASH_BATCH_FILES or batch_bytes >= HASH_BATCH_BYTES:
+            yield batch
+            batch = []
+            batch_bytes = 0
+    if batch:
+        yield batch
+
+# Runs in a worker process: returns the digests of each file, or None for files that could not be read.
+def _hash_batch(root, relative_paths, algorithms):
+    results = []
+    for relative_path in relative_paths:
+        try:
+            results.append(_hash_file(os.path.join(root, relative_path), algorithms))
+        except OSError:
+            results.append(None)
+    return results
+
+def _hash_file(path, algorithms):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            hasher = downloads.MultiHasher(algorithms)
+            for chunk in iter(lambda: f.read(downloads.CHUNK_SIZE), b""):
+                hasher.update(chunk)
+            return hasher.hexdigests()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            hasher = downloads.MultiHasher(algorithms)
+            hasher.update(mapped)
+            return hasher.hexdigests()
+
+def _load_index(index_path):
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path, "r") as f:
+            return json.load(f)
+    except ValueError:
+        print(f"WARNING: Ignoring unreadable tree index at {index_path}")
+        return {}
+
+def _save_index(index_path, index):
+    directory = os.path.dirname(os.path.abspath(index_path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
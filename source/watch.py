@@ -0,0 +1,104 @@
+import datetime
+import json
+import os
+import tempfile
+import time
+from . import allowlists, batch, github, intoto_tools, trace
+
+# Seconds between polls, and where the last verified release of each repository is recorded.
+DEFAULT_INTERVAL = 300
+DEFAULT_STATE_FILE = "bridge-state.json"
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, "r") as f:
+        return json.load(f)
+
+def save_state(state_path, state):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(state_path)), suffix=".json")
+    with os.fdopen(fd, "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+# Checks every manifest entry for a release that has not been verified yet, and
+# verifies only those. The state records, per repository, the last verified tag
+# and the digests Github reports for its assets; a new tag whose assets all
+# match already-verified digests is recorded without downloading anything.
+# Verified hashes of new releases are appended to policy in each of
+# hash_algorithms, unless their destination path matches excludelist. Default
+# in-toto layouts are cached in layout_cache_dir (see batch.verify_entry).
+# Returns the amended policy and whether anything was appended to it.
+def poll(entries, token, downloader, state, policy, graphql_batch_size=github.DEFAULT_BATCH_SIZE, excludelist=None, hash_algorithms=("sha256",), layout_cache_dir=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR):
+    repos = [(entry["owner"], entry["repository"], entry.get("tag")) for entry in entries]
+    with trace.span("github.fetch_releases_batch", repositories=len(repos)):
+        releases = github.fetch_releases_batch(repos, token, graphql_batch_size)
+
+    amended = False
+    for entry, repo in zip(entries, repos):
+        key = github.release_key(*repo)
+        release = releases.get(key)
+        if release is None:
+            continue
+
+        seen = state.get(key)
+        if seen and seen["tag"] == release["tag"]:
+            continue
+
+        asset_digests = {asset["name"]: asset.get("digest") for asset in release["assets"]}
+        if seen and all(asset_digests.values()) and asset_digests == seen["assets"]:
+            print(f"{key}: Release {release['tag']} has the same assets as verified release {seen['tag']}, skipping")
+            seen["tag"] = release["tag"]
+            continue
+
+        print(f"{key}: Verifying new release {release['tag']}")
+        try:
+            verified_digests = batch.verify_entry(entry, token, downloader, github.organize_assets(release["assets"]), release["tag"], layout_cache_dir)
+        except Exception as e:
+            print(f"{key}: Verification of release {release['tag']} failed, will retry on the next poll: {e}")
+            continue
+
+        verified_hashes = [digests["sha256"] for digests in verified_digests]
+        if not verified_hashes:
+            print(f"{key}: No artifact hashes of release {release['tag']} were verified, will retry on the next poll")
+            continue
+        if entry.get("destination_app_path") and not (excludelist and excludelist.matches(entry["destination_app_path"])):
+            policy = allowlists.append_digests_to_allowlist(policy, entry["destination_app_path"], verified_digests[0], hash_algorithms)
+            amended = True
+
+        state[key] = {
+            "tag": release["tag"],
+            "assets": asset_digests,
+            "verified_hashes": verified_hashes,
+            "verified_at": str(datetime.datetime.now()),
+        }
+
+    return policy, amended
+
+# Polls every interval seconds until interrupted; a failing poll is reported and
+# retried on the next interval. The policy at policy_path (or the allowlist at
+# allowlist_path if it does not exist yet) is amended in place whenever a new
+# release is verified, and each amended policy is also committed to store if
+# given. Paths matching excludelist are never added, and
+# verified binaries are added with their digests in each of hash_algorithms.
+def watch(entries, token, downloader, policy_path, state_path=DEFAULT_STATE_FILE, interval=DEFAULT_INTERVAL, allowlist_path=None, graphql_batch_size=github.DEFAULT_BATCH_SIZE, compress=False, store=None, retire_after=0, excludelist=None, hash_algorithms=("sha256",), layout_cache_dir=intoto_tools.DEFAULT_LAYOUT_CACHE_DIR):
+    state = load_state(state_path)
+    policy = allowlists.get_allowlist(policy_path if os.path.exists(policy_path) else allowlist_path, excludelist)
+
+    while True:
+        try:
+            policy, amended = poll(entries, token, downloader, state, policy, graphql_batch_size, excludelist, hash_algorithms, layout_cache_dir)
+        except Exception as e:
+            # Github being unreachable or returning errors should not stop the
+            # daemon; the same releases are looked up again on the next poll.
+            print(f"Polling for new releases failed, will retry in {interval} seconds: {e}")
+            time.sleep(interval)
+            continue
+        if amended:
+            if store:
+                release = store.commit(policy, retire_after)
+                print(f"Policy stored as release {release} in {store.directory}")
+            allowlists.save_allowlist(policy, policy_path, compress)
+            print(f"Amended policy written to {policy_path}")
+        save_state(state_path, state)
+        time.sleep(interval)
@@ -0,0 +1,66 @@
+import io
+import json
+import unittest
+from unittest import mock
+
+from source import allowlists
+
+# A JSON allowlist whose numbers, strings and hashes entries get split at every
+# possible position by the chunk-size sweep below.
+DOCUMENT = json.dumps({
+    "meta": {"version": 5, "ratio": 1.5, "scale": -2.25e-3, "big": 1E+10},
+    "release": 12.75,
+    "hashes": {
+        "/usr/bin/a": ["a" * 64],
+        "/usr/bin/b\\u00e9": ["b" * 64, "c" * 64],
+    },
+    "keyrings": {},
+    "ima": {"dm_policy": None, "ignored_keyrings": [], "log_hash_alg": "sha256", "weights": [0.5, 10, -3e2, 1.0e+1]},
+    "last": 3.0,
+})
+
+class ReadAllowlistJSONTest(unittest.TestCase):
+    def test_every_chunk_size_matches_json_loads(self):
+        expected = json.loads(DOCUMENT)
+        expected_hashes = expected.pop("hashes")
+        for chunk_size in range(1, len(DOCUMENT) + 2):
+            with self.subTest(chunk_size=chunk_size), mock.patch.object(allowlists, "READ_CHUNK_SIZE", chunk_size):
+                alist = allowlists.read_allowlist_json(io.StringIO(DOCUMENT))
+                document = dict(alist.document)
+                self.assertIsNone(document.pop("hashes"))
+                self.assertEqual(document, expected)
+                self.assertEqual({path: alist.get(path) for path in expected_hashes}, expected_hashes)
+
+    def test_number_split_at_chunk_boundary(self):
+        document = '{"release": 1.5e+3, "hashes": {}}'
+        for chunk_size in range(len('{"release": 1'), len('{"release": 1.5e+3') + 1):
+            with self.subTest(chunk_size=chunk_size), mock.patch.object(allowlists, "READ_CHUNK_SIZE", chunk_size):
+                self.assertEqual(allowlists.read_allowlist_json(io.StringIO(document)).document["release"], 1500.0)
+
+class AllowlistRoundTripTest(unittest.TestCase):
+    def test_hashes_are_written_back_as_read(self):
+        document = json.dumps({
+            "meta": {"version": 5},
+            "release": 0,
+            "hashes": {"/lower": ["ab" * 32], "/upper": ["AB" * 32], "/mixed": ["Ab" * 32, "ab" * 32], "/odd": ["abc", "ab cd"]},
+            "keyrings": {},
+        })
+        for hashes in (allowlists.read_allowlist_json(io.StringIO(document)), allowlists.Allowlist(json.loads(document))):
+            output = io.StringIO()
+            allowlists.write_allowlist_json(hashes, output)
+            self.assertEqual(output.getvalue(), document)
+
+class ExcludelistTest(unittest.TestCase):
+    def test_inline_flags_apply_to_their_own_pattern(self):
+        excludelist = allowlists.Excludelist(["(?i)/tmp/cache", "/usr/bin/tool", "/usr/lib/.*\\.so"])
+        self.assertTrue(excludelist.matches("/TMP/Cache"))
+        self.assertTrue(excludelist.matches("/usr/bin/tool"))
+        self.assertFalse(excludelist.matches("/USR/BIN/TOOL"))
+        self.assertTrue(excludelist.matches("/usr/lib/libc.so"))
+
+    def test_misplaced_global_flags_are_rejected(self):
+        with self.assertRaisesRegex(ValueError, "/tmp/\\(\\?i\\)cache"):
+            allowlists.Excludelist(["/usr/bin/tool", "/tmp/(?i)cache"])
+
+if __name__ == "__main__":
+    unittest.main()